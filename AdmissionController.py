@@ -0,0 +1,111 @@
+from collections import deque
+from itertools import count
+from pydantic import BaseModel
+from typing import List
+import asyncio
+import heapq
+import time
+import logging
+
+
+class AdmissionParams(BaseModel):
+    max_concurrent: int = 8
+    max_queue: int = 32
+    deadline: float = 30.0
+    retry_after: int = 5
+
+
+class QueueFull(Exception):
+    def __init__(self, retry_after: int) -> None:
+        super().__init__("Очередь запросов переполнена")
+        self.retry_after: int = retry_after
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, retry_after: int) -> None:
+        super().__init__("Запрос не дождался своей очереди")
+        self.retry_after: int = retry_after
+
+
+class AdmissionController:
+    def __init__(self, params: AdmissionParams) -> None:
+        self.params: AdmissionParams = params
+        self.__waiting: list = []
+        self.__order = count()
+        self.__active: int = 0
+        self.__admitted: int = 0
+        self.__rejected: int = 0
+        self.__expired: int = 0
+        self.__wait_times: deque = deque(maxlen=1000)
+
+    @property
+    def queued(self) -> int:
+        return len([entry for entry in self.__waiting if not entry[2].done()])
+
+    @staticmethod
+    def __percentile(values: List[float], percentile: float) -> float:
+        if not values:
+            return 0.0
+        return values[min(int(len(values) * percentile), len(values) - 1)]
+
+    @property
+    def stats(self) -> dict:
+        wait_times: List[float] = sorted(self.__wait_times)
+        return {
+            "active": self.__active,
+            "queued": self.queued,
+            "max_concurrent": self.params.max_concurrent,
+            "max_queue": self.params.max_queue,
+            "admitted": self.__admitted,
+            "rejected": self.__rejected,
+            "expired": self.__expired,
+            "wait_p50": self.__percentile(wait_times, 0.5),
+            "wait_p95": self.__percentile(wait_times, 0.95),
+            "wait_max": wait_times[-1] if wait_times else 0.0,
+        }
+
+    def __admit(self, start: float) -> None:
+        self.__active += 1
+        self.__admitted += 1
+        self.__wait_times.append(time.monotonic() - start)
+
+    async def acquire(self, priority: int, deadline: float = 0) -> None:
+        start: float = time.monotonic()
+        if self.__active < self.params.max_concurrent and not self.queued:
+            self.__admit(start)
+            return
+        if self.queued >= self.params.max_queue:
+            self.__rejected += 1
+            logging.warning(
+                "Запрос отклонён: в очереди %s, выполняется %s", self.queued, self.__active)
+            raise QueueFull(self.params.retry_after)
+        # при равном приоритете порядок поступления сохраняется
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.__waiting, (priority, next(self.__order), future))
+        try:
+            await asyncio.wait_for(future, timeout=deadline or self.params.deadline)
+        except asyncio.TimeoutError:
+            self.__expired += 1
+            logging.warning(
+                "Запрос снят с очереди по дедлайну через %.1f с", time.monotonic() - start)
+            raise DeadlineExceeded(self.params.retry_after)
+        except asyncio.CancelledError:
+            # клиент ушёл в момент выдачи места — место возвращается очереди
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        self.__wait_times.append(time.monotonic() - start)
+
+    def release(self) -> None:
+        self.__active -= 1
+        self.dispatch()
+
+    def dispatch(self) -> None:
+        # место передаётся первому ещё ожидающему запросу с наивысшим приоритетом
+        while self.__waiting and self.__active < self.params.max_concurrent:
+            _, _, future = heapq.heappop(self.__waiting)
+            if future.done():
+                continue
+            self.__active += 1
+            self.__admitted += 1
+            future.set_result(None)
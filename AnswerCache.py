@@ -0,0 +1,85 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import List, Optional
+import numpy as np
+import time
+import logging
+
+
+class AnswerCache:
+    def __init__(self, threshold: float = 0.92, max_size: int = 512, ttl: float = 3600) -> None:
+        self.threshold: float = threshold
+        self.__max_size: int = max_size
+        self.__ttl: float = ttl
+        self.__entries: OrderedDict = OrderedDict()
+        self.__lock = Lock()
+        self.__order: int = 0
+        self.__version: int = 0
+        self.__hits: int = 0
+        self.__misses: int = 0
+
+    @staticmethod
+    def normalize(embedding: List[float]) -> np.ndarray:
+        vector: np.ndarray = np.asarray(embedding, dtype=np.float32)
+        norm: float = float(np.linalg.norm(vector))
+        return vector / norm if norm > 0 else vector
+
+    @property
+    def version(self) -> int:
+        return self.__version
+
+    @property
+    def stats(self) -> dict:
+        requests: int = self.__hits + self.__misses
+        return {
+            "hits": self.__hits,
+            "misses": self.__misses,
+            "hit_rate": self.__hits / requests if requests else 0.0,
+            "size": len(self.__entries),
+            "max_size": self.__max_size,
+            "threshold": self.threshold,
+        }
+
+    def get(self, embedding: List[float], names: frozenset) -> Optional[str]:
+        vector: np.ndarray = self.normalize(embedding)
+        now: float = time.monotonic()
+        with self.__lock:
+            for key in [key for key, entry in self.__entries.items() if now - entry[3] > self.__ttl]:
+                self.__entries.pop(key)
+            # ответ переиспользуется только при том же наборе активных баз знаний
+            candidates: list = [(key, entry) for key, entry in self.__entries.items()
+                                if entry[1] == names]
+            if candidates:
+                similarities: np.ndarray = np.stack(
+                    [entry[0] for _, entry in candidates]) @ vector
+                best: int = int(similarities.argmax())
+                if similarities[best] >= self.threshold:
+                    key, entry = candidates[best]
+                    self.__entries.move_to_end(key)
+                    self.__hits += 1
+                    logging.info(
+                        "Ответ взят из кэша, сходство %.3f", similarities[best])
+                    return entry[2]
+            self.__misses += 1
+            return None
+
+    def put(self, embedding: List[float], names: frozenset, answer: str, version: int) -> None:
+        with self.__lock:
+            # пока шла генерация, базу знаний могли изменить — такой ответ не кэшируется
+            if version != self.__version or not answer:
+                return
+            self.__order += 1
+            self.__entries[self.__order] = (
+                self.normalize(embedding), names, answer, time.monotonic())
+            while len(self.__entries) > self.__max_size:
+                self.__entries.popitem(last=False)
+
+    def invalidate(self, name: Optional[str] = None) -> None:
+        with self.__lock:
+            self.__version += 1
+            if name is None:
+                self.__entries.clear()
+                return
+            for key in [key for key, entry in self.__entries.items() if name in entry[1]]:
+                self.__entries.pop(key)
+        logging.info("Сброс кэша ответов для базы знаний %s", name)
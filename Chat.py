@@ -1,8 +1,5 @@
-import json
-from typing import List, Dict
+from typing import List, Dict, Optional
 import logging
-logging.basicConfig(level=logging.INFO, filename="py_log.log", filemode="a",
-                    format="%(asctime)s %(levelname)s %(message)s")
 
 
 class Pair:
@@ -12,35 +9,27 @@ class Pair:
 
 
 class Chat:
-    def __init__(self, path: str = "", chat_name: str = "", id: int = 0) -> None:
-        self.__path: str = path
+    def __init__(self, storage, chat_name: str = "", id: int = 0, history: Optional[List[Dict]] = None) -> None:
+        self.__storage = storage
         self.__chat_name: str = chat_name
-        self.__chat_history: List[Dict] = []
+        self.__chat_history: List[Dict] = history if history is not None else []
         self.__id: int = id
 
     def load_chat(self) -> None:
-        with open(self.__path, 'r', encoding='utf-8') as file:
-            data = json.load(file)
-        self.__chat_name = data["chat_name"]
-        self.__id = data["id"]
-        self.__chat_history = data["chat_history"]
-        logging.info(f"Загружен чат {self.__chat_name}")
+        self.__chat_name, self.__chat_history = self.__storage.load(self.__id)
+        logging.info("Загружен чат %s", self.__chat_name)
 
     def add_pair(self, pair: Pair) -> None:
-        self.__chat_history.append(
-            {
-                "user": pair.user,
-                "bot": pair.bot
-            }
-        )
-        logging.info(f"Добавление истории в чат {self.__chat_name}")
-        if not self.__path:
-            self.__path = "./chats" + '/' + str(self.__id) + '.json'
-        with open(self.__path, 'w', encoding='utf-8') as file:
-            file.write(json.dumps({"chat_name": self.__chat_name, "id": self.__id,
-                       "chat_history": self.__chat_history}, ensure_ascii=False))
+        record: Dict = {
+            "user": pair.user,
+            "bot": pair.bot
+        }
+        self.__chat_history.append(record)
+        logging.info("Добавление истории в чат %s", self.__chat_name)
+        # в хранилище дописывается только новый ход, а не вся история
+        self.__storage.append_pair(self.__id, self.__chat_name, record)
         logging.info(
-            f"Сохранение истории чата {self.chat_name} -> {self.__path}")
+            "Сохранение истории чата %s -> %s", self.chat_name, self.path)
 
     @property
     def chat_name(self) -> str:
@@ -53,6 +42,7 @@ class Chat:
     @chat_name.setter
     def chat_name(self, chat_name: str) -> None:
         self.__chat_name = chat_name
+        self.__storage.rename(self.__id, chat_name)
 
     @property
     def chat_history(self) -> List[Dict]:
@@ -60,4 +50,4 @@ class Chat:
 
     @property
     def path(self) -> str:
-        return self.__path
+        return self.__storage.chat_path(self.__id)
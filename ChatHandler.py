@@ -1,58 +1,69 @@
 import os
+from collections import OrderedDict
+from threading import Lock
 from typing import Dict, List
 from Chat import Chat
+from ChatStorage import create_chat_storage, migrate_json_chats
 import logging
-logging.basicConfig(level=logging.INFO, filename="py_log.log", filemode="a",
-                    format="%(asctime)s %(levelname)s %(message)s")
 
 
 class ChatHandler:
-    def __init__(self, path) -> None:
+    def __init__(self, path, backend: str = "jsonl", cache_size: int = 128) -> None:
         self.__path: str = path
-        self.__chats: Dict = dict()
+        self.__chats: OrderedDict = OrderedDict()
+        self.__cache_size: int = cache_size
+        self.__lock = Lock()
+        os.makedirs(self.__path, exist_ok=True)
+        self.__storage = create_chat_storage(self.__path, backend)
+        migrate_json_chats(self.__path, self.__storage)
         self.load_chats()
 
     def load_chats(self) -> None:
-        logging.info("Загрузка чатов")
-        dirs: List[str] = os.listdir(self.__path)
-        for file in dirs:
-            chat = Chat(self.__path+'/'+file)
-            chat.load_chat()
-            self.__chats[chat.id] = chat
-        logging.info(f"Загружено чатов {len(dirs)}")
+        # при запуске читается только индекс, истории загружаются по запросу
+        logging.info("Загрузка индекса чатов")
+        self.__next_id: int = self.__storage.next_id()
+        logging.info("Чатов в индексе %s", len(self.__storage.list_chats()))
 
     def __call__(self, id: int) -> Chat:
-        logging.info(f"Вызов чата id:{id}")
-        return self.__chats[id]
+        logging.debug("Вызов чата id:%s", id)
+        with self.__lock:
+            if id in self.__chats:
+                self.__chats.move_to_end(id)
+                return self.__chats[id]
+            chat = Chat(self.__storage, id=id)
+            try:
+                chat.load_chat()
+            except FileNotFoundError:
+                raise KeyError(id)
+            self.__chats[id] = chat
+            while len(self.__chats) > self.__cache_size:
+                self.__chats.popitem(last=False)
+            return chat
 
     def create_chat(self, chat_name: str) -> int:
-        logging.info(f"Создание чата {chat_name}")
-        used_ids: List[int] = []
-        logging.info(f"Генерация id чата {chat_name}")
-        for chat in self.__chats.values():
-            used_ids.append(chat.id)
-        id: int = len(self.__chats)
-        for i, chat in enumerate(self.__chats.values()):
-            try:
-                self.__chats[i]
-            except:
-                id = i
-                break
-        print(id)
-        logging.info(f"Id чата {id} для {chat_name}")
-        self.__chats[id] = Chat(chat_name=chat_name, id=id)
+        logging.info("Создание чата %s", chat_name)
+        with self.__lock:
+            id: int = self.__next_id
+            self.__next_id += 1
+        logging.info("Id чата %s для %s", id, chat_name)
+        self.__storage.create(id, chat_name)
         return id
 
     def chat_names(self) -> List[str]:
         logging.info("Получение метаданных чатов")
-        return [dict({"chat_name": chat[1].chat_name, "id": chat[0]}) for chat in self.__chats.items()]
+        return [dict({"chat_name": chat["chat_name"], "id": chat["id"]}) for chat in self.__storage.list_chats()]
+
+    def chat_history(self, id: int, offset: int = 0, limit: int = 0) -> List[Dict]:
+        history: List[Dict] = self(id).chat_history
+        return history[offset:offset + limit] if limit > 0 else history[offset:]
 
     def remove_chat(self, id: int = 0) -> bool:
         try:
-            os.remove(self.__chats[id].path)
-            self.__chats.pop(id)
-            logging.info(f"Чат {id} был удалён")
+            self.__storage.remove(id)
+            with self.__lock:
+                self.__chats.pop(id, None)
+            logging.info("Чат %s был удалён", id)
             return True
         except:
-            logging.info(f"Чат {id} не был удалён")
+            logging.info("Чат %s не был удалён", id)
             return False
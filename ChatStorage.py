@@ -0,0 +1,268 @@
+import json
+import os
+import sqlite3
+import time
+from threading import Lock, Thread
+from typing import Dict, List, Set, Tuple
+import logging
+
+
+class JsonlChatStorage:
+    def __init__(self, path: str, fsync_interval: float = 1.0) -> None:
+        self.__path: str = path
+        self.__fsync_interval: float = fsync_interval
+        self.__dirty: Set[str] = set()
+        self.__lock = Lock()
+        self.__index: Dict[int, Dict] = self.__load_index()
+        self.__index_dirty: bool = False
+        self.__flusher = Thread(target=self.__flush_loop, daemon=True)
+        self.__flusher.start()
+
+    def chat_path(self, id: int) -> str:
+        return "{path}/{id}.jsonl".format(path=self.__path, id=id)
+
+    def list_chats(self) -> List[Dict]:
+        with self.__lock:
+            return [dict(meta) for meta in self.__index.values()]
+
+    def next_id(self) -> int:
+        with self.__lock:
+            return max(self.__index.keys(), default=-1) + 1
+
+    def load(self, id: int) -> Tuple[str, List[Dict]]:
+        return self.__read(self.chat_path(id))
+
+    def create(self, id: int, chat_name: str) -> None:
+        self.__append(self.chat_path(id), [
+                      {"type": "meta", "id": id, "chat_name": chat_name}])
+        with self.__lock:
+            self.__index[id] = {"id": id, "chat_name": chat_name,
+                                "path": self.chat_path(id), "turns": 0}
+        # новый чат сразу попадает в индекс на диске, счётчики ходов сбрасываются пачкой
+        self.__write_index()
+
+    def append_pair(self, id: int, chat_name: str, pair: Dict) -> None:
+        if id not in self.__index:
+            self.create(id, chat_name)
+        self.__append(self.chat_path(id), [{"type": "pair", **pair}])
+        with self.__lock:
+            self.__index[id]["turns"] += 1
+            self.__index_dirty = True
+
+    def rename(self, id: int, chat_name: str) -> None:
+        if id not in self.__index:
+            return
+        self.__append(self.chat_path(id), [
+                      {"type": "meta", "id": id, "chat_name": chat_name}])
+        with self.__lock:
+            self.__index[id]["chat_name"] = chat_name
+        self.__write_index()
+
+    def import_chat(self, id: int, chat_name: str, history: List[Dict]) -> None:
+        records: List[Dict] = [{"type": "meta", "id": id, "chat_name": chat_name}] + \
+            [{"type": "pair", **pair} for pair in history]
+        temporary: str = self.chat_path(id) + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            file.write("".join([json.dumps(record, ensure_ascii=False) + "\n"
+                                for record in records]))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.chat_path(id))
+        with self.__lock:
+            self.__index[id] = {"id": id, "chat_name": chat_name,
+                                "path": self.chat_path(id), "turns": len(history)}
+        self.__write_index()
+
+    def remove(self, id: int) -> None:
+        with self.__lock:
+            self.__dirty.discard(self.chat_path(id))
+        os.remove(self.chat_path(id))
+        with self.__lock:
+            self.__index.pop(id, None)
+        self.__write_index()
+
+    def flush(self) -> None:
+        with self.__lock:
+            dirty, self.__dirty = self.__dirty, set()
+            index_dirty, self.__index_dirty = self.__index_dirty, False
+        if index_dirty:
+            self.__write_index()
+        for path in dirty:
+            try:
+                descriptor: int = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(descriptor)
+                finally:
+                    os.close(descriptor)
+            except FileNotFoundError:
+                pass
+
+    def __append(self, path: str, records: List[Dict]) -> None:
+        # одна запись на ход: стоимость не зависит от длины истории, fsync выполняется пачкой
+        with open(path, "a", encoding="utf-8") as file:
+            file.write("".join([json.dumps(record, ensure_ascii=False) + "\n"
+                                for record in records]))
+        with self.__lock:
+            self.__dirty.add(path)
+
+    def __load_index(self) -> Dict[int, Dict]:
+        try:
+            with open("{path}/index.json".format(path=self.__path), "r", encoding="utf-8") as file:
+                return {int(id): meta for id, meta in json.load(file).items()}
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+        # индекса ещё нет: он строится один раз по файлам чатов
+        logging.info("Построение индекса чатов")
+        index: Dict[int, Dict] = dict()
+        for file in os.listdir(self.__path):
+            if file.endswith(".jsonl"):
+                id: int = int(file[:-len(".jsonl")])
+                chat_name, history = self.__read(self.chat_path(id))
+                index[id] = {"id": id, "chat_name": chat_name,
+                             "path": self.chat_path(id), "turns": len(history)}
+        self.__index = index
+        self.__write_index()
+        return index
+
+    def __write_index(self) -> None:
+        with self.__lock:
+            data: str = json.dumps(
+                {str(id): meta for id, meta in self.__index.items()}, ensure_ascii=False)
+            temporary: str = "{path}/index.json.tmp".format(path=self.__path)
+            with open(temporary, "w", encoding="utf-8") as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, "{path}/index.json".format(path=self.__path))
+
+    def __read(self, path: str) -> Tuple[str, List[Dict]]:
+        chat_name: str = ""
+        history: List[Dict] = []
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record: Dict = json.loads(line)
+                except json.JSONDecodeError:
+                    # недописанная при сбое строка пропускается
+                    logging.error("Повреждённая запись чата %s пропущена", path)
+                    continue
+                if record.pop("type") == "meta":
+                    chat_name = record["chat_name"]
+                else:
+                    history.append(record)
+        return chat_name, history
+
+    def __flush_loop(self) -> None:
+        while True:
+            time.sleep(self.__fsync_interval)
+            self.flush()
+
+
+class SqliteChatStorage:
+    def __init__(self, path: str) -> None:
+        self.__path: str = "{path}/chats.sqlite3".format(path=path)
+        self.__lock = Lock()
+        self.__connection = sqlite3.connect(
+            self.__path, check_same_thread=False)
+        # WAL с synchronous=NORMAL: fsync выполняется на контрольных точках, а не на каждом ходе
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.execute(
+            "CREATE TABLE IF NOT EXISTS chats (id INTEGER PRIMARY KEY, chat_name TEXT NOT NULL)")
+        self.__connection.execute(
+            "CREATE TABLE IF NOT EXISTS pairs (chat_id INTEGER NOT NULL, turn INTEGER NOT NULL, "
+            "user TEXT NOT NULL, bot TEXT NOT NULL, PRIMARY KEY (chat_id, turn))")
+        self.__connection.commit()
+
+    def chat_path(self, id: int) -> str:
+        return self.__path
+
+    def list_chats(self) -> List[Dict]:
+        with self.__lock:
+            return [{"id": id, "chat_name": chat_name, "path": self.__path, "turns": turns}
+                    for id, chat_name, turns in self.__connection.execute(
+                "SELECT chats.id, chats.chat_name, COUNT(pairs.turn) FROM chats "
+                "LEFT JOIN pairs ON pairs.chat_id = chats.id GROUP BY chats.id")]
+
+    def next_id(self) -> int:
+        with self.__lock:
+            return self.__connection.execute("SELECT COALESCE(MAX(id) + 1, 0) FROM chats").fetchone()[0]
+
+    def create(self, id: int, chat_name: str) -> None:
+        with self.__lock:
+            self.__connection.execute(
+                "INSERT OR REPLACE INTO chats (id, chat_name) VALUES (?, ?)", (id, chat_name))
+            self.__connection.commit()
+
+    def load(self, id: int) -> Tuple[str, List[Dict]]:
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT chat_name FROM chats WHERE id = ?", (id,)).fetchone()
+            if row is None:
+                raise FileNotFoundError(id)
+            history: List[Dict] = [{"user": user, "bot": bot} for user, bot in self.__connection.execute(
+                "SELECT user, bot FROM pairs WHERE chat_id = ? ORDER BY turn", (id,))]
+        return row[0], history
+
+    def append_pair(self, id: int, chat_name: str, pair: Dict) -> None:
+        with self.__lock:
+            self.__connection.execute(
+                "INSERT OR IGNORE INTO chats (id, chat_name) VALUES (?, ?)", (id, chat_name))
+            self.__connection.execute(
+                "INSERT INTO pairs (chat_id, turn, user, bot) VALUES "
+                "(?, (SELECT COALESCE(MAX(turn) + 1, 0) FROM pairs WHERE chat_id = ?), ?, ?)",
+                (id, id, pair["user"], pair["bot"]))
+            self.__connection.commit()
+
+    def rename(self, id: int, chat_name: str) -> None:
+        with self.__lock:
+            self.__connection.execute(
+                "UPDATE chats SET chat_name = ? WHERE id = ?", (chat_name, id))
+            self.__connection.commit()
+
+    def import_chat(self, id: int, chat_name: str, history: List[Dict]) -> None:
+        with self.__lock:
+            self.__connection.execute(
+                "INSERT OR REPLACE INTO chats (id, chat_name) VALUES (?, ?)", (id, chat_name))
+            self.__connection.executemany(
+                "INSERT OR REPLACE INTO pairs (chat_id, turn, user, bot) VALUES (?, ?, ?, ?)",
+                [(id, turn, pair["user"], pair["bot"]) for turn, pair in enumerate(history)])
+            self.__connection.commit()
+
+    def remove(self, id: int) -> None:
+        with self.__lock:
+            deleted: int = self.__connection.execute(
+                "DELETE FROM chats WHERE id = ?", (id,)).rowcount
+            self.__connection.execute(
+                "DELETE FROM pairs WHERE chat_id = ?", (id,))
+            self.__connection.commit()
+        if not deleted:
+            raise FileNotFoundError(id)
+
+    def flush(self) -> None:
+        with self.__lock:
+            self.__connection.execute("PRAGMA wal_checkpoint(FULL)")
+
+
+def create_chat_storage(path: str, backend: str = "jsonl"):
+    if backend == "sqlite":
+        return SqliteChatStorage(path)
+    return JsonlChatStorage(path)
+
+
+def migrate_json_chats(path: str, storage) -> int:
+    # разовый перенос чатов из формата ChatTemplate.json; исходные файлы переименовываются
+    migrated: int = 0
+    for file in os.listdir(path):
+        if not file.endswith(".json") or file == "index.json":
+            continue
+        source: str = "{path}/{file}".format(path=path, file=file)
+        with open(source, "r", encoding="utf-8") as chat_file:
+            data: Dict = json.load(chat_file)
+        storage.import_chat(data["id"], data["chat_name"], data["chat_history"])
+        os.rename(source, source + ".migrated")
+        migrated += 1
+    if migrated:
+        storage.flush()
+        logging.info("Перенесено чатов из JSON %s", migrated)
+    return migrated
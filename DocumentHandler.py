@@ -1,32 +1,42 @@
 import docx
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
+from typing import Callable, Iterator, Optional
 import logging
-logging.basicConfig(level=logging.INFO, filename="py_log.log", filemode="a",
-                    format="%(asctime)s %(levelname)s %(message)s")
 
 
 class DocumentHandler:
-    def __init__(self, url: str) -> None:
-        self.__extract_text(url)
-        self.__text_processing()
+    def __init__(self, url: str, chunk_size: int = 400, chunk_overlap: int = 100, window: int = 16) -> None:
+        logging.info("Обработка документа %s", url)
+        self.__document = docx.Document(url)
+        self.__text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+        )
+        self.__window: int = chunk_size * window
 
-    def __extract_text(self, url) -> None:
-        logging.info(f"Обработка документа {url}")
-        document = docx.Document(url)
-        texts = []
-        for paragraph in document.paragraphs:
-            texts.append(paragraph.text)
-        self.__text = "".join(texts)
+    @property
+    def paragraphs_count(self) -> int:
+        return len(self.__document.paragraphs)
 
-    def __text_processing(self) -> None:
-        logging.info(f"Разбиение текста документа на чанки")
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=400,
-            chunk_overlap=100,
-        )
-        self.__cleared_documents = text_splitter.create_documents([
-                                                                  self.__text])
+    def iter_documents(self, progress: Optional[Callable[[int], None]] = None) -> Iterator[Document]:
+        logging.info("Потоковое разбиение текста документа на чанки")
+        buffer: str = ""
+        for number, paragraph in enumerate(self.__document.paragraphs, 1):
+            buffer = "\n".join([buffer, paragraph.text]
+                               ) if buffer else paragraph.text
+            if len(buffer) >= self.__window:
+                chunks = self.__text_splitter.split_text(buffer)
+                # последний чанк может продолжиться следующими абзацами
+                for chunk in chunks[:-1]:
+                    yield Document(page_content=chunk)
+                buffer = chunks[-1] if chunks else ""
+            if progress is not None:
+                progress(number)
+        if buffer.strip():
+            for chunk in self.__text_splitter.split_text(buffer):
+                yield Document(page_content=chunk)
 
     @property
     def documents(self) -> list:
-        return self.__cleared_documents
+        return list(self.iter_documents())
@@ -0,0 +1,118 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+from queue import Queue, Empty
+from threading import Lock, Thread
+from typing import Dict, List, Tuple
+from metrics import metrics
+import time
+import logging
+
+
+class EmbeddingService:
+    def __init__(self, embeddings, max_batch_size: int = 32, window_ms: float = 5.0, cache_size: int = 4096) -> None:
+        self.embeddings = embeddings
+        self.__max_batch_size: int = max_batch_size
+        self.__window: float = window_ms / 1000
+        self.__cache_size: int = cache_size
+        self.__cache: OrderedDict = OrderedDict()
+        self.__lock = Lock()
+        self.__queue: Queue = Queue()
+        # у моделей с инструкцией запроса эмбеддинг вопроса отличается от эмбеддинга документа
+        self.__symmetric: bool = not getattr(
+            embeddings, "query_instruction", None)
+        self.__requests: int = 0
+        self.__hits: int = 0
+        self.__batches: int = 0
+        self.__batched_texts: int = 0
+        self.__wait_seconds: float = 0.0
+        self.__thread = Thread(target=self.__loop, daemon=True)
+        self.__thread.start()
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "requests": self.__requests,
+            "cache_hits": self.__hits,
+            "cache_size": len(self.__cache),
+            "batches": self.__batches,
+            "mean_batch_size": self.__batched_texts / self.__batches if self.__batches else 0.0,
+            "mean_wait_seconds": self.__wait_seconds / self.__batched_texts if self.__batched_texts else 0.0,
+        }
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_queries([text])[0]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        # одинаковые тексты эмбеддятся один раз, недавние берутся из кэша
+        found: Dict[str, List[float]] = {}
+        with self.__lock:
+            self.__requests += len(texts)
+            for text in texts:
+                if text in self.__cache:
+                    self.__cache.move_to_end(text)
+                    found[text] = self.__cache[text]
+            self.__hits += len([text for text in texts if text in found])
+        futures: Dict[str, Future] = {}
+        for text in texts:
+            if text not in found and text not in futures:
+                futures[text] = Future()
+                self.__queue.put((text, futures[text], time.perf_counter()))
+        for text, future in futures.items():
+            found[text] = future.result()
+        return [found[text] for text in texts]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        # документы при загрузке уже идут пачками, поэтому считаются сразу в вызывающем потоке
+        unique: List[str] = list(dict.fromkeys(texts))
+        with metrics.timer("diplom_embedding_documents_seconds"):
+            vectors: Dict[str, List[float]] = dict(
+                zip(unique, self.embeddings.embed_documents(unique)))
+        metrics.observe("diplom_embedding_batch_size",
+                        len(unique), kind="documents")
+        return [vectors[text] for text in texts]
+
+    def __collect(self) -> List[Tuple[str, Future, float]]:
+        batch: List[Tuple[str, Future, float]] = [self.__queue.get()]
+        # запросы, пришедшие за короткое окно, считаются одним проходом модели
+        deadline: float = time.perf_counter() + self.__window
+        while len(batch) < self.__max_batch_size:
+            timeout: float = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.__queue.get(timeout=timeout))
+            except Empty:
+                break
+        return batch
+
+    def __loop(self) -> None:
+        while True:
+            batch: List[Tuple[str, Future, float]] = self.__collect()
+            start: float = time.perf_counter()
+            texts: List[str] = list(dict.fromkeys([text for text, _, _ in batch]))
+            try:
+                with metrics.timer("diplom_embedding_seconds"):
+                    if self.__symmetric:
+                        vectors: List[List[float]] = self.embeddings.embed_documents(texts)
+                    else:
+                        vectors = [self.embeddings.embed_query(text) for text in texts]
+            except Exception as error:
+                logging.error("Эмбеддинг запросов не удался: %s", error)
+                for _, future, _ in batch:
+                    future.set_exception(error)
+                continue
+            embedded: Dict[str, List[float]] = dict(zip(texts, vectors))
+            with self.__lock:
+                for text, vector in embedded.items():
+                    self.__cache[text] = vector
+                    self.__cache.move_to_end(text)
+                while len(self.__cache) > self.__cache_size:
+                    self.__cache.popitem(last=False)
+                self.__batches += 1
+                self.__batched_texts += len(batch)
+                self.__wait_seconds += sum([start - queued for _, _, queued in batch])
+            metrics.observe("diplom_embedding_batch_size", len(texts), kind="queries")
+            for _, _, queued in batch:
+                metrics.observe("diplom_embedding_wait_seconds", start - queued)
+            for text, future, _ in batch:
+                future.set_result(embedded[text])
@@ -0,0 +1,92 @@
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Callable, Dict, List, Optional
+import logging
+
+
+class IngestionJob:
+    def __init__(self, kind: str, name: str, url: str, description: str = "") -> None:
+        self.id: str = uuid.uuid4().hex
+        self.kind: str = kind
+        self.name: str = name
+        self.url: str = url
+        self.description: str = description
+        self.status: str = "queued"
+        self.error: str = ""
+        self.paragraphs_done: int = 0
+        self.paragraphs_total: int = 0
+        self.chunks: int = 0
+        self.created: float = time.time()
+        self.started: float = 0.0
+        self.finished: float = 0.0
+
+    def progress(self, paragraphs_done: int) -> None:
+        self.paragraphs_done = paragraphs_done
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "name": self.name,
+            "url": self.url,
+            "description": self.description,
+            "status": self.status,
+            "error": self.error,
+            "paragraphs_done": self.paragraphs_done,
+            "paragraphs_total": self.paragraphs_total,
+            "chunks": self.chunks,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class IngestionQueue:
+    def __init__(self, workers: int = 2, max_history: int = 256) -> None:
+        self.__pool: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="ingestion")
+        self.__jobs: Dict[str, IngestionJob] = dict()
+        self.__max_history: int = max_history
+        self.__lock = Lock()
+
+    def submit(self, kind: str, name: str, url: str, target: Callable[[IngestionJob], bool],
+               description: str = "") -> str:
+        job = IngestionJob(kind, name, url, description)
+        with self.__lock:
+            self.__jobs[job.id] = job
+            self.__forget_finished()
+        self.__pool.submit(self.__run, job, target)
+        logging.info("Задача загрузки %s поставлена в очередь -> %s", job.id, name)
+        return job.id
+
+    def status(self, job_id: str) -> Optional[dict]:
+        job: Optional[IngestionJob] = self.__jobs.get(job_id)
+        return job.to_dict() if job is not None else None
+
+    def jobs(self) -> List[dict]:
+        with self.__lock:
+            return [job.to_dict() for job in self.__jobs.values()]
+
+    def active_names(self) -> List[str]:
+        with self.__lock:
+            return [job.name for job in self.__jobs.values() if job.status in ("queued", "running")]
+
+    def __run(self, job: IngestionJob, target: Callable[[IngestionJob], bool]) -> None:
+        job.status = "running"
+        job.started = time.time()
+        try:
+            job.status = "done" if target(job) else "failed"
+        except Exception as error:
+            job.error = str(error)
+            job.status = "failed"
+        job.finished = time.time()
+        logging.info(
+            "Задача загрузки %s завершена со статусом %s", job.id, job.status)
+
+    def __forget_finished(self) -> None:
+        finished: List[str] = [job_id for job_id, job in self.__jobs.items()
+                               if job.status in ("done", "failed")]
+        for job_id in finished[:max(0, len(self.__jobs) - self.__max_history)]:
+            self.__jobs.pop(job_id)
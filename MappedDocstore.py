@@ -0,0 +1,105 @@
+import mmap
+import os
+import pickle
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+from langchain_community.docstore.base import AddableMixin, Docstore
+from langchain_core.documents import Document
+
+DOCSTORE_DATA = "docstore.bin"
+DOCSTORE_OFFSETS = "docstore.idx"
+
+
+def write_docstore(path: str, documents: Iterable[Document]) -> None:
+    # фрагменты пишутся подряд, смещения — отдельным массивом, чтобы читать их через отображение в память
+    offsets: List[int] = [0]
+    with open(os.path.join(path, DOCSTORE_DATA), "wb") as file:
+        for document in documents:
+            file.write(pickle.dumps((document.page_content, document.metadata)))
+            offsets.append(file.tell())
+        file.flush()
+        os.fsync(file.fileno())
+    with open(os.path.join(path, DOCSTORE_OFFSETS), "wb") as file:
+        np.save(file, np.array(offsets, dtype=np.int64))
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def docstore_exists(path: str) -> bool:
+    return os.path.exists(os.path.join(path, DOCSTORE_OFFSETS))
+
+
+class MappedDocstore(Docstore, AddableMixin):
+    # снимок читается из общего для всех процессов кэша страниц, в памяти процесса — только дозаписи журнала
+    def __init__(self, path: str) -> None:
+        self.__offsets: np.ndarray = np.load(
+            os.path.join(path, DOCSTORE_OFFSETS), mmap_mode="r")
+        self.__data: Optional[mmap.mmap] = None
+        with open(os.path.join(path, DOCSTORE_DATA), "rb") as file:
+            if os.fstat(file.fileno()).st_size:
+                self.__data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.__added: Dict[str, Document] = {}
+
+    @property
+    def count(self) -> int:
+        return len(self.__offsets) - 1
+
+    def search(self, search: Union[str, int]) -> Union[str, Document]:
+        if isinstance(search, (int, np.integer)) and 0 <= search < self.count:
+            start, end = int(self.__offsets[search]), int(self.__offsets[search + 1])
+            page_content, metadata = pickle.loads(self.__data[start:end])
+            return Document(page_content=page_content, metadata=metadata)
+        if search in self.__added:
+            return self.__added[search]
+        return "ID {search} not found.".format(search=search)
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        overlapping = set(texts).intersection(self.__added)
+        if overlapping:
+            raise ValueError("Tried to add ids that already exist: {ids}".format(ids=overlapping))
+        self.__added.update(texts)
+
+    def delete(self, ids: List) -> None:
+        for id in ids:
+            self.__added.pop(id, None)
+
+
+class MappedIds(dict):
+    # позиция фрагмента в снимке сама служит ключом docstore, поэтому словарь позиций не хранится
+    def __init__(self, count: int) -> None:
+        super().__init__()
+        self.__count: int = count
+
+    def __getitem__(self, position: int):
+        if 0 <= position < self.__count:
+            return position
+        return super().__getitem__(position)
+
+    def get(self, position: int, default=None):
+        try:
+            return self[position]
+        except KeyError:
+            return default
+
+    def __contains__(self, position) -> bool:
+        if isinstance(position, (int, np.integer)) and 0 <= position < self.__count:
+            return True
+        return super().__contains__(position)
+
+    def __len__(self) -> int:
+        return self.__count + super().__len__()
+
+    def items(self) -> Iterator[Tuple[int, object]]:
+        for position in range(self.__count):
+            yield position, position
+        yield from super().items()
+
+    def values(self) -> Iterator[object]:
+        return (value for _, value in self.items())
+
+    def keys(self) -> Iterator[int]:
+        return (key for key, _ in self.items())
+
+    def __iter__(self):
+        return iter(self.keys())
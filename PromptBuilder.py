@@ -0,0 +1,112 @@
+from langchain_core.documents import Document
+from pydantic import BaseModel
+from typing import Callable, List, Set, Tuple
+import re
+import logging
+
+
+class PromptParams(BaseModel):
+    context_window: int = 4096
+    max_context_tokens: int = 1536
+    duplicate_threshold: float = 0.8
+    min_overlap: int = 20
+    min_chunk_tokens: int = 16
+
+
+class PromptBuilder:
+    def __init__(self, tokenizer, params: PromptParams) -> None:
+        self.__tokenizer = tokenizer
+        self.params: PromptParams = params
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.__tokenizer.encode(text, add_special_tokens=False))
+
+    @staticmethod
+    def __shingles(text: str, size: int = 3) -> Set[Tuple[str, ...]]:
+        words: List[str] = re.findall(r"\w+", text.lower())
+        return {tuple(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+    @staticmethod
+    def __similarity(first: Set[Tuple[str, ...]], second: Set[Tuple[str, ...]]) -> float:
+        if not first or not second:
+            return 0.0
+        return len(first & second) / len(first | second)
+
+    def __trim_overlap(self, text: str, selected: List[str]) -> str:
+        # соседние фрагменты при загрузке перекрываются, повтор на стыке вырезается
+        for chunk in selected:
+            for length in range(min(len(chunk), len(text)), self.params.min_overlap - 1, -1):
+                if chunk.endswith(text[:length]):
+                    text = text[length:]
+                    break
+                if chunk.startswith(text[-length:]):
+                    text = text[:-length]
+                    break
+        return text.strip()
+
+    def __truncate(self, text: str, tokens: int) -> str:
+        ids: List[int] = self.__tokenizer.encode(
+            text, add_special_tokens=False)[:tokens]
+        return self.__tokenizer.decode(ids, skip_special_tokens=True)
+
+    def fit_history(self, head: str, turns: List[str], tail: str, max_new_tokens: int) -> Tuple[str, int]:
+        # история не должна вытеснять ответ из окна: старые ходы отбрасываются первыми
+        limit: int = self.params.context_window - max_new_tokens
+        tokens: List[int] = [self.count_tokens(turn) for turn in turns]
+        fixed: int = self.count_tokens(head) + self.count_tokens(tail)
+        start: int = 0
+        while start < len(turns) and fixed + sum(tokens[start:]) > limit:
+            start += 1
+        # на стыках BPE счёт по частям может немного расходиться, итог проверяется целиком
+        while start < len(turns) and self.count_tokens(head + "".join(turns[start:]) + tail) > limit:
+            start += 1
+        if start:
+            logging.warning(
+                "История диалога не помещается в окно %s, отброшено ходов %s", self.params.context_window, start)
+        return head + "".join(turns[start:]), start
+
+    def build(self, render: Callable[[str], str], documents: List[Tuple[Document, float]],
+              max_new_tokens: int) -> Tuple[str, dict]:
+        # под ответ резервируется max_new_tokens, остаток окна делят шаблон и контекст
+        base_tokens: int = self.count_tokens(render(""))
+        budget: int = min(self.params.max_context_tokens,
+                          self.params.context_window - max_new_tokens - base_tokens)
+        if budget <= 0:
+            logging.warning(
+                "Нет места для контекста: шаблон %s токенов, ответ %s", base_tokens, max_new_tokens)
+        selected: List[str] = []
+        shingles: List[Set[Tuple[str, ...]]] = []
+        used: int = 0
+        dropped: int = 0
+        for document, _ in documents:
+            if used >= budget:
+                dropped += 1
+                continue
+            text: str = self.__trim_overlap(document.page_content, selected)
+            text_shingles = self.__shingles(text)
+            if not text or any(self.__similarity(text_shingles, other) >= self.params.duplicate_threshold
+                               for other in shingles):
+                dropped += 1
+                continue
+            tokens: int = self.count_tokens(text) + 1
+            if used + tokens > budget:
+                # фрагменты идут по убыванию релевантности, последний обрезается под остаток
+                if budget - used - 1 < self.params.min_chunk_tokens:
+                    dropped += 1
+                    continue
+                text = self.__truncate(text, budget - used - 1)
+                tokens = budget - used
+            selected.append(text)
+            shingles.append(text_shingles)
+            used += tokens
+        prompt: str = render(" ".join(selected))
+        stats: dict = {
+            "prompt_tokens": len(self.__tokenizer.encode(prompt)),
+            "context_tokens": used,
+            "context_budget": max(budget, 0),
+            "chunks": len(selected),
+            "dropped_chunks": dropped,
+        }
+        logging.info(
+            "Промпт %s токенов, контекст %s/%s, фрагментов %s, отброшено %s", stats['prompt_tokens'], used, stats['context_budget'], len(selected), dropped)
+        return prompt, stats
@@ -1,26 +1,291 @@
 from langchain.vectorstores import FAISS
 from DocumentHandler import DocumentHandler
+from IngestionQueue import IngestionJob, IngestionQueue
+from metrics import metrics
+from EmbeddingService import EmbeddingService
+from WriteAheadLog import WalRecord, WriteAheadLog
+from device import DeviceParams, load_embeddings
+from index_factory import IndexParams, apply_search_params, add_vectors, build_store, training_size, store_documents, store_vectors, save_params, load_params, shareable_index
+from MappedDocstore import DOCSTORE_DATA, MappedDocstore, MappedIds, docstore_exists, write_docstore
 from langchain_core.documents import Document
-from typing import List
-import torch
+from typing import Callable, Iterator, List, Optional, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pydantic import BaseModel
+from contextlib import contextmanager
+from threading import Condition, Lock, RLock
+import faiss
+import json
+import pickle
+import uuid
+import numpy as np
+import time
 import os
 import shutil
 import logging
-logging.basicConfig(level=logging.INFO, filename="py_log.log", filemode="a",
-                    format="%(asctime)s %(levelname)s %(message)s")
+
+
+class RetrieverParams(BaseModel):
+    k: int = 4
+    # оценка langchain 1 - d/√2 по квадрату L2 бывает отрицательной, поэтому по умолчанию отсечки нет
+    score_threshold: Optional[float] = None
+
+
+class ReadWriteLock:
+    # поиски по одному индексу идут параллельно, дозапись ждёт их и останавливает новые
+    def __init__(self) -> None:
+        self.__condition = Condition()
+        self.__readers: int = 0
+        self.__writer: bool = False
+        self.__waiting_writers: int = 0
+
+    @contextmanager
+    def read(self):
+        with self.__condition:
+            while self.__writer or self.__waiting_writers:
+                self.__condition.wait()
+            self.__readers += 1
+        try:
+            yield
+        finally:
+            with self.__condition:
+                self.__readers -= 1
+                if not self.__readers:
+                    self.__condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.__condition:
+            self.__waiting_writers += 1
+            while self.__writer or self.__readers:
+                self.__condition.wait()
+            self.__waiting_writers -= 1
+            self.__writer = True
+        try:
+            yield
+        finally:
+            with self.__condition:
+                self.__writer = False
+                self.__condition.notify_all()
 
 
 class Retriever:
-    def __init__(self, name: str, retriever, status: bool = True) -> None:
+    def __init__(self, name: str, root: str, embeddings, status: bool = True, store: Optional[FAISS] = None,
+                 params: Optional[IndexParams] = None, read_only: bool = False) -> None:
         self.name = name
+        self.read_only: bool = read_only
         self.status = status
-        self.retriever = retriever
+        self.lock = RLock()
+        self.index_lock: ReadWriteLock = ReadWriteLock()
+        self.compacting: bool = False
+        self.__root: str = root
+        # параметры читаются сразу, чтобы статус невыгруженной базы показывал её настоящий тип индекса
+        self.params: IndexParams = params or load_params(self.path)
+        self.__embeddings = embeddings
+        self.__store: Optional[FAISS] = store
+        self.__mapped: bool = False
+        self.__wal: Optional[WriteAheadLog] = None
+        self.__resident_size: int = self.__docstore_size() + \
+            self.__file_size("index.faiss") if store is not None else 0
+
+    @property
+    def path(self) -> str:
+        return "{root}/{name}".format(root=self.__root, name=self.name)
+
+    @property
+    def snapshot_path(self) -> str:
+        # CURRENT указывает на действующий снимок; у старых баз снимок лежит прямо в каталоге
+        try:
+            with open("{path}/CURRENT".format(path=self.path), "r", encoding="utf-8") as file:
+                return "{path}/{snapshot}".format(path=self.path, snapshot=file.read().strip())
+        except FileNotFoundError:
+            return self.path
 
-    def __call__(self, question: str) -> str:
-        logging.info(f"Поиск документа в базе знаний {self.name}")
-        if self.status:
-            return " ".join([doc.page_content for doc in self.retriever.invoke(question)])
-        return ""
+    @property
+    def wal(self) -> WriteAheadLog:
+        path: str = "{path}/wal.log".format(path=self.path)
+        if self.__wal is None or self.__wal.path != path:
+            self.__wal = WriteAheadLog(
+                path, self.read_only, self.__snapshot_seq(self.snapshot_path))
+        return self.__wal
+
+    @property
+    def loaded(self) -> bool:
+        return self.__store is not None
+
+    @property
+    def mapped(self) -> bool:
+        return self.__mapped
+
+    @property
+    def resident_size(self) -> int:
+        return self.__resident_size if self.loaded else 0
+
+    @property
+    def disk_size(self) -> int:
+        return self.__docstore_size() + self.__file_size("index.faiss")
+
+    @property
+    def store(self) -> FAISS:
+        with self.lock:
+            if self.__store is None:
+                self.load()
+            return self.__store
+
+    @property
+    def writable_store(self) -> FAISS:
+        # в отображённый в память индекс писать нельзя, поэтому перед записью он читается целиком
+        with self.lock:
+            if self.__store is None or self.__mapped:
+                self.load(mmap=False)
+            return self.__store
+
+    def load(self, mmap: bool = True) -> None:
+        with self.lock:
+            snapshot_path: str = self.snapshot_path
+            pending: List[WalRecord] = list(
+                self.wal.replay(self.__snapshot_seq(snapshot_path)))
+            index_path: str = "{path}/index.faiss".format(path=snapshot_path)
+            self.__mapped = False
+            index = None
+            if mmap and not pending:
+                try:
+                    index = faiss.read_index(
+                        index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+                    self.__mapped = self.__supports_mmap(index)
+                except RuntimeError:
+                    index = None
+            if index is None:
+                index = faiss.read_index(index_path)
+            self.params = load_params(self.path)
+            apply_search_params(index, self.params)
+            if docstore_exists(snapshot_path):
+                # фрагменты читаются из отображённого файла, общего для всех процессов
+                docstore = MappedDocstore(snapshot_path)
+                index_to_docstore_id = MappedIds(docstore.count)
+            else:
+                with open("{path}/index.pkl".format(path=snapshot_path), "rb") as file:
+                    docstore, index_to_docstore_id = pickle.load(file)
+            store = FAISS(self.__embeddings, index,
+                          docstore, index_to_docstore_id)
+            # записи журнала, не попавшие в снимок, применяются поверх него
+            for record in pending:
+                store.add_embeddings(zip(record.texts, record.vectors.tolist()),
+                                     metadatas=record.metadatas, ids=record.ids)
+            self.__store = store
+            self.__resident_size = self.__file_size("index.pkl") + \
+                (0 if self.__mapped else self.__file_size("index.faiss"))
+            logging.info(
+                "Загружена база знаний %s, отображение в память: %s, записей журнала: %s", self.name, self.__mapped, len(pending))
+
+    def append(self, store: FAISS, documents: List[Document], vectors: np.ndarray) -> int:
+        with self.lock:
+            ids: List[str] = [uuid.uuid4().hex for _ in documents]
+            texts: List[str] = [document.page_content for document in documents]
+            metadatas: List[dict] = [
+                document.metadata for document in documents]
+            self.wal.append(ids, texts, metadatas, vectors)
+            with self.index_lock.write():
+                store.add_embeddings(zip(texts, vectors.tolist()),
+                                     metadatas=metadatas, ids=ids)
+            return self.wal.records
+
+    def save(self, store: FAISS) -> None:
+        with self.lock, self.index_lock.read():
+            seq: int = self.wal.last_seq
+            # плоский индекс пишется как IVF с одним списком, чтобы обработчики могли отобразить его в память
+            index_bytes: bytes = faiss.serialize_index(
+                shareable_index(store.index)).tobytes()
+            documents: List[Document] = store_documents(store)
+        # снимок пишется в новый каталог и подменяется атомарно, запросы и запись в журнал не ждут
+        previous: str = self.snapshot_path
+        snapshot: str = "snapshot-{seq}-{stamp}".format(
+            seq=seq, stamp=uuid.uuid4().hex[:8])
+        temporary: str = "{path}/.{snapshot}".format(
+            path=self.path, snapshot=snapshot)
+        os.makedirs(temporary)
+        write_docstore(temporary, documents)
+        for file_name, data in (("index.faiss", index_bytes),
+                                ("snapshot.json", json.dumps({"seq": seq}).encode("utf-8"))):
+            with open("{path}/{file}".format(path=temporary, file=file_name), "wb") as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+        os.rename(temporary, "{path}/{snapshot}".format(path=self.path, snapshot=snapshot))
+        with open("{path}/CURRENT.tmp".format(path=self.path), "w", encoding="utf-8") as file:
+            file.write(snapshot)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace("{path}/CURRENT.tmp".format(path=self.path),
+                   "{path}/CURRENT".format(path=self.path))
+        self.wal.truncate(seq)
+        if previous == self.path:
+            for file_name in ("index.faiss", "index.pkl"):
+                if os.path.exists("{path}/{file}".format(path=previous, file=file_name)):
+                    os.remove("{path}/{file}".format(path=previous, file=file_name))
+        else:
+            shutil.rmtree(previous, ignore_errors=True)
+        logging.info("Сохранён снимок базы знаний %s -> %s", self.name, snapshot)
+
+    def compact(self) -> bool:
+        try:
+            # выгруженная база не открывается заново: журнал сожмётся при следующей записи
+            store: Optional[FAISS] = self.__store
+            if store is None or not self.wal.records:
+                return False
+            self.save(store)
+            return True
+        finally:
+            self.compacting = False
+
+    def replace(self, store: FAISS, params: IndexParams) -> None:
+        with self.lock:
+            self.__store = store
+            self.params = params
+            self.__mapped = False
+            self.__resident_size = self.__docstore_size() + self.__file_size("index.faiss")
+
+    def unload(self) -> None:
+        with self.lock:
+            if self.__store is None:
+                return
+            self.__store = None
+            self.__mapped = False
+            logging.info("Выгружена база знаний %s", self.name)
+
+    def search(self, store: FAISS, embedding: List[float], k: int) -> List[Tuple[Document, float]]:
+        # поиск идёт по хранилищу, открытому через учёт памяти; само свойство store его не переоткрывает
+        # поиск и дозапись в индекс faiss не должны идти одновременно, поиски между собой — могут
+        with self.index_lock.read():
+            relevance = store._select_relevance_score_fn()
+            return [(doc, relevance(score)) for doc, score in store.similarity_search_with_score_by_vector(embedding, k)]
+
+    @staticmethod
+    def __snapshot_seq(snapshot_path: str) -> int:
+        try:
+            with open("{path}/snapshot.json".format(path=snapshot_path), "r", encoding="utf-8") as file:
+                return json.load(file)["seq"]
+        except FileNotFoundError:
+            return 0
+
+    @staticmethod
+    def __supports_mmap(index) -> bool:
+        # отображаются в память только инвертированные списки IVF; плоский индекс в снимке уже записан как IVF
+        try:
+            faiss.extract_index_ivf(index)
+            return True
+        except RuntimeError:
+            return False
+
+    def __docstore_size(self) -> int:
+        # у старых снимков docstore лежит в index.pkl, у новых — в отображаемом docstore.bin
+        return self.__file_size("index.pkl") or self.__file_size(DOCSTORE_DATA)
+
+    def __file_size(self, file: str) -> int:
+        try:
+            return os.path.getsize("{path}/{file}".format(path=self.snapshot_path, file=file))
+        except OSError:
+            return 0
 
     def __eq__(self, name: str) -> bool:
         if self.name == name:
@@ -28,36 +293,241 @@ class Retriever:
         return False
 
 
+class QueryCache:
+    def __init__(self, max_size: int = 1024, ttl: float = 600) -> None:
+        self.__max_size: int = max_size
+        self.__ttl: float = ttl
+        self.__entries: OrderedDict = OrderedDict()
+        self.__lock = Lock()
+        self.__version: int = 0
+        self.__hits: int = 0
+        self.__misses: int = 0
+
+    @staticmethod
+    def normalize(question: str) -> str:
+        return " ".join(question.lower().split())
+
+    @property
+    def version(self) -> int:
+        return self.__version
+
+    @property
+    def stats(self) -> dict:
+        requests: int = self.__hits + self.__misses
+        return {
+            "hits": self.__hits,
+            "misses": self.__misses,
+            "hit_rate": self.__hits / requests if requests else 0.0,
+            "size": len(self.__entries),
+            "max_size": self.__max_size,
+        }
+
+    def get(self, question: str, names: frozenset) -> Optional[list]:
+        key = (self.normalize(question), names)
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None or time.monotonic() - entry[1] > self.__ttl:
+                self.__entries.pop(key, None)
+                self.__misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.__hits += 1
+            return entry[0]
+
+    def put(self, question: str, names: frozenset, context: list, version: int) -> None:
+        with self.__lock:
+            # пока шёл поиск, базу знаний могли изменить — такой результат не кэшируется
+            if version != self.__version:
+                return
+            self.__entries[(self.normalize(question), names)] = (
+                context, time.monotonic())
+            self.__entries.move_to_end((self.normalize(question), names))
+            while len(self.__entries) > self.__max_size:
+                self.__entries.popitem(last=False)
+
+    def invalidate(self, name: str) -> None:
+        with self.__lock:
+            self.__version += 1
+            for key in [key for key in self.__entries if name in key[1]]:
+                self.__entries.pop(key)
+        logging.info("Сброс кэша запросов для базы знаний %s", name)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__version += 1
+            self.__entries.clear()
+
+
 class RetrieverHandler:
-    def __init__(self, path='./database') -> None:
+    def __init__(self, path='./database', memory_cap_mb: int = 4096, batch_size: int = 64,
+                 compact_records: int = 256, compact_mb: int = 64, device_params: Optional[DeviceParams] = None,
+                 read_only: bool = False) -> None:
         self.__path = path
+        self.__read_only: bool = read_only
+        self.__device_params: DeviceParams = device_params or DeviceParams()
+        self.__batch_size: int = batch_size
+        self.__compact_records: int = compact_records
+        self.__compact_bytes: int = compact_mb * 1024 * 1024
+        self.__compaction_pool: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="compaction")
+        self.__ingestion: IngestionQueue = IngestionQueue()
         self.__retrievers: list = []
+        self.__memory_cap: int = memory_cap_mb * 1024 * 1024
+        self.__loaded: OrderedDict = OrderedDict()
+        self.__loaded_lock = Lock()
+        self.__params: RetrieverParams = RetrieverParams()
+        self.__query_cache: QueryCache = QueryCache()
+        self.__invalidation_listeners: List[Callable[[Optional[str]], None]] = []
+        self.__search_pool: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=4)
         self.__load_retrievers()
 
     def __load_retrievers(self) -> None:
-        logging.info(f"Загрузка слоя эмбеддинга")
-        self.__embeddings = torch.load(
+        logging.info("Загрузка слоя эмбеддинга")
+        self.__embeddings = load_embeddings(
             '{path}/embeddings/embeddings.pt'.format(path=self.__path),
-            map_location=torch.device('cuda:0')
+            self.__device_params
         )
+        self.__embedding_service: EmbeddingService = EmbeddingService(
+            self.__embeddings)
         dirs: List[str] = os.listdir(
             '{path}/knowladge'.format(path=self.__path))
-        logging.info(f"Загрузка баз знаний")
+        # базы знаний открываются лениво при первом запросе
+        for data in dirs:
+            self.__retrievers.append(
+                Retriever(data, self.__knowladge_path, self.__embeddings, read_only=self.__read_only))
+        logging.info("Найдено баз знаний %s", len(dirs))
+
+    @property
+    def __knowladge_path(self) -> str:
+        return '{path}/knowladge'.format(path=self.__path)
+
+    def __open(self, retriever: Retriever, writable: bool = False) -> FAISS:
+        store: FAISS = retriever.writable_store if writable else retriever.store
+        with self.__loaded_lock:
+            self.__loaded[id(retriever)] = retriever
+            self.__loaded.move_to_end(id(retriever))
+            victims: List[Retriever] = []
+            size: int = sum(
+                [loaded.resident_size for loaded in self.__loaded.values()])
+            for loaded in list(self.__loaded.values())[:-1]:
+                if size <= self.__memory_cap:
+                    break
+                size -= loaded.resident_size
+                victims.append(self.__loaded.pop(id(loaded)))
+        # холодные базы закрываются вне общей блокировки, чтобы не ждать чужую загрузку
+        for victim in victims:
+            victim.unload()
+        return store
+
+    def __close(self, retriever: Retriever) -> None:
+        with self.__loaded_lock:
+            self.__loaded.pop(id(retriever), None)
+        retriever.unload()
+
+    def add_invalidation_listener(self, listener: Callable[[Optional[str]], None]) -> None:
+        self.__invalidation_listeners.append(listener)
+
+    def __invalidate(self, name: Optional[str] = None) -> None:
+        # None означает, что изменились параметры поиска и устарело всё
+        if name is None:
+            self.__query_cache.clear()
+        else:
+            self.__query_cache.invalidate(name)
+        for listener in self.__invalidation_listeners:
+            listener(name)
+
+    @property
+    def active_names(self) -> frozenset:
+        return frozenset([retriever.name for retriever in self.__retrievers if retriever.status])
+
+    def embed_query(self, question: str) -> List[float]:
+        return self.__embedding_service.embed_query(question)
+
+    @property
+    def embedding_stats(self) -> dict:
+        return self.__embedding_service.stats
+
+    def refresh(self, name: Optional[str] = None) -> None:
+        # базу изменил другой процесс: открытая копия выгружается и перечитается с диска при следующем поиске
+        if name is None:
+            self.__invalidate()
+            return
+        dirs: List[str] = os.listdir(self.__knowladge_path)
+        for retriever in list(self.__retrievers):
+            if retriever.name not in dirs:
+                self.__close(retriever)
+                self.__retrievers.remove(retriever)
         for data in dirs:
-            retriever = FAISS.load_local(
-                "{path}/knowladge/{data}".format(data=data, path=self.__path),
-                self.__embeddings,
-                allow_dangerous_deserialization=True
-            ).as_retriever(
-                search_kwargs={'k': 1}
-            )
-            self.__retrievers.append(Retriever(data, retriever))
-            logging.info(f"Загружена база знаний {data}")
-        logging.info(f"Загружено баз знаний {len(dirs)}")
+            if self.__getitem__(data) is None:
+                self.__retrievers.append(
+                    Retriever(data, self.__knowladge_path, self.__embeddings, read_only=self.__read_only))
+        retriever = self.__getitem__(name)
+        if retriever is not None:
+            self.__close(retriever)
+        self.__invalidate(name)
+        logging.info("База знаний %s обновлена с диска", name)
+
+    def preload(self, names: List[str]) -> None:
+        # по умолчанию базы открываются лениво; заранее открывается только заданный горячий набор
+        # ("*" — все активные) и только пока он помещается в лимит памяти
+        if not names:
+            return
+        candidates: List[Retriever] = [retriever for retriever in self.__retrievers
+                                       if retriever.status and ("*" in names or retriever.name in names)]
+        selected: List[Retriever] = []
+        size: int = 0
+        for retriever in candidates:
+            if size + retriever.disk_size > self.__memory_cap:
+                break
+            size += retriever.disk_size
+            selected.append(retriever)
+        list(self.__search_pool.map(self.__open, selected))
+        logging.info("Предзагружено баз знаний %s из %s", len(selected), len(candidates))
+
+    def warmup(self) -> None:
+        self.__embedding_service.embed_query("warmup")
 
     def get_retrievers_status(self) -> list:
-        logging.info(f"Получение статуса активности баз знаний")
-        return [{"name": retriever.name, "active_status": retriever.status} for retriever in self.__retrievers]
+        logging.info("Получение статуса активности баз знаний")
+        return [{"name": retriever.name, "active_status": retriever.status, "loaded": retriever.loaded,
+                 "mapped": retriever.mapped, "resident_bytes": retriever.resident_size,
+                 "index_type": retriever.params.index_type} for retriever in self.__retrievers]
+
+    @property
+    def cache_stats(self) -> dict:
+        return self.__query_cache.stats
+
+    @property
+    def params(self) -> dict:
+        return {"k": self.__params.k, "score_threshold": self.__params.score_threshold}
+
+    def set_params(self, k: int = 0, score_threshold: float = -1) -> None:
+        if k > 0:
+            logging.info("Изменение параметра k %s -> %s", self.__params.k, k)
+            self.__params.k = k
+        if score_threshold >= 0:
+            logging.info(
+                "Изменение параметра score_threshold %s -> %s", self.__params.score_threshold, score_threshold)
+            self.__params.score_threshold = score_threshold
+        self.__invalidate()
+
+    def activate_retriever(self, name: str) -> bool:
+        return self.__set_retriever_status(name, True)
+
+    def deactivate_retriever(self, name: str) -> bool:
+        return self.__set_retriever_status(name, False)
+
+    def __set_retriever_status(self, name: str, status: bool) -> bool:
+        retriever = self.__getitem__(name)
+        if retriever is None:
+            logging.error(
+                "Изменение активности базы знаний %s не удалось", name)
+            return False
+        retriever.status = status
+        self.__invalidate(name)
+        logging.info("Изменение активности базы знаний %s -> %s", name, status)
+        return True
 
     def change_retriever_name(self, old_name: str, new_name: str) -> bool:
         try:
@@ -65,67 +535,223 @@ class RetrieverHandler:
                                                        data=old_name), '{path}/knowladge/{data}'.format(path=self.__path,
                                                                                                         data=new_name))
             self.__getitem__(old_name).name = new_name
+            self.__invalidate(old_name)
+            self.__invalidate(new_name)
             logging.info(
-                f"Изменение имени базы знаний {old_name} -> {new_name}")
+                "Изменение имени базы знаний %s -> %s", old_name, new_name)
             return True
         except:
             logging.error(
-                f"Изменение имени базы знаний {old_name} -> {new_name} не удалось")
+                "Изменение имени базы знаний %s -> %s не удалось", old_name, new_name)
             return False
 
     def remove_retriever(self, name: str) -> bool:
         try:
+            retriever = self.__getitem__(name)
+            self.__close(retriever)
             shutil.rmtree(
                 '{path}/knowladge/{data}'.format(path=self.__path, data=name))
             self.__retrievers.remove(name)
-            logging.info(f"Удаление базы знаний {name}")
+            self.__invalidate(name)
+            logging.info("Удаление базы знаний %s", name)
             return True
         except:
-            logging.error(f"Удаление базы знаний {name} не удалось")
+            logging.error("Удаление базы знаний %s не удалось", name)
             return False
 
     def add_text_in_retriever(self, name: str, text: str) -> bool:
         try:
-            self.__getitem__(name).retriever.add_documents([Document(text)])
-            logging.info(f"Добавление документа в базу знаний {name}")
+            documents: List[Document] = [Document(text)]
+            self.__append(self.__getitem__(name), documents,
+                          self.__embed_documents(documents))
+            logging.info("Добавление документа в базу знаний %s", name)
             return True
         except:
             logging.error(
-                f"Добавление документа в базу знаний {name} не удалось")
+                "Добавление документа в базу знаний %s не удалось", name)
             return False
 
-    def add_document_in_retriever(self, name: str, url: str) -> bool:
+    def __append(self, retriever: Retriever, documents: List[Document], vectors: np.ndarray) -> None:
+        # запись сначала попадает в журнал на диске, затем в индекс в памяти
+        store: FAISS = self.__open(retriever, writable=True)
+        records: int = retriever.append(store, documents, vectors)
+        self.__invalidate(retriever.name)
+        with retriever.lock:
+            if retriever.compacting or (records < self.__compact_records and
+                                        retriever.wal.size < self.__compact_bytes):
+                return
+            retriever.compacting = True
+        self.__compaction_pool.submit(retriever.compact)
+
+    def __batches(self, doc_handler: DocumentHandler, job: Optional[IngestionJob]) -> Iterator[List[Document]]:
+        if job is not None:
+            job.paragraphs_total = doc_handler.paragraphs_count
+        batch: List[Document] = []
+        for document in doc_handler.iter_documents(job.progress if job is not None else None):
+            batch.append(document)
+            if len(batch) >= self.__batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def __embed_documents(self, documents: List[Document]) -> np.ndarray:
+        return np.array(self.__embedding_service.embed_documents(
+            [document.page_content for document in documents]), dtype=np.float32)
+
+    def add_document_in_retriever(self, name: str, url: str, job: Optional[IngestionJob] = None) -> bool:
         try:
+            retriever = self.__getitem__(name)
             doc_handler = DocumentHandler(url)
-            self.__getitem__(name).retriever.add_documents(
-                doc_handler.documents)
-            logging.info(f"Добавление документов -> {name}")
+            # чанки эмбеддятся пачками фиксированного размера и сразу дописываются в индекс
+            for batch in self.__batches(doc_handler, job):
+                self.__append(retriever, batch, self.__embed_documents(batch))
+                if job is not None:
+                    job.chunks += len(batch)
+            logging.info("Добавление документов -> %s", name)
             return True
-        except:
-            logging.error(f"Ошибка добавления документов -> {name}")
+        except Exception as error:
+            if job is not None:
+                job.error = str(error)
+            logging.error("Ошибка добавления документов -> %s: %s", name, error)
             return False
 
-    def create_retriever_from_document(self, name: str, url: str) -> bool:
+    def create_retriever_from_document(self, name: str, url: str, index_params: Optional[IndexParams] = None,
+                                       job: Optional[IngestionJob] = None) -> bool:
         try:
+            params: IndexParams = index_params or IndexParams()
             doc_handler = DocumentHandler(url)
-            db = FAISS.from_documents(doc_handler.documents, self.__embeddings)
-            db.save_local("{path}/knowladge/{data}".format(data=name,
-                          path=self.__path))
-            retriever = db.as_retriever(search_kwargs={'k': 1})
-            self.__retrievers.append(Retriever(name, retriever))
+            db: Optional[FAISS] = None
+            # IVF обучается на первых векторах, до этого пачки копятся в памяти
+            pending: List[Document] = []
+            pending_vectors: List[np.ndarray] = []
+            for batch in self.__batches(doc_handler, job):
+                vectors: np.ndarray = self.__embed_documents(batch)
+                if db is None:
+                    pending += batch
+                    pending_vectors.append(vectors)
+                    if len(pending) >= training_size(params):
+                        db = build_store(self.__embeddings, pending,
+                                         np.concatenate(pending_vectors), params)
+                        pending, pending_vectors = [], []
+                else:
+                    add_vectors(db, batch, vectors)
+                if job is not None:
+                    job.chunks += len(batch)
+            if db is None:
+                db = build_store(self.__embeddings, pending,
+                                 np.concatenate(pending_vectors) if pending_vectors else None, params)
+            retriever = Retriever(
+                name, self.__knowladge_path, self.__embeddings, params=params)
+            os.makedirs(retriever.path, exist_ok=True)
+            save_params(retriever.path, params)
+            retriever.save(db)
+            retriever.replace(db, params)
+            self.__retrievers.append(retriever)
+            self.__open(retriever)
+            self.__invalidate(name)
             logging.info(
-                f"Создание базы знаний {name} из документов {url}")
+                "Создание базы знаний %s из документов %s", name, url)
             return True
-        except:
+        except Exception as error:
+            if job is not None:
+                job.error = str(error)
             logging.error(
-                f"Создание базы знаний {name} из документов {url} не удалось")
+                "Создание базы знаний %s из документов %s не удалось: %s", name, url, error)
             return False
 
-    def __call__(self, question: str):
-        docs = []
-        for retriever in self.__retrievers:
-            docs.append(retriever(question))
-        return " ".join([doc for doc in docs])
+    def submit_document_in_retriever(self, name: str, url: str) -> Optional[str]:
+        if self.__getitem__(name) is None:
+            logging.error("База знаний %s не найдена", name)
+            return None
+        return self.__ingestion.submit("add", name, url, lambda job: self.add_document_in_retriever(name, url, job))
+
+    def submit_retriever_from_document(self, name: str, url: str, index_params: Optional[IndexParams] = None) -> Optional[str]:
+        if self.__getitem__(name) is not None or name in self.__ingestion.active_names():
+            logging.error("База знаний %s уже существует", name)
+            return None
+        return self.__ingestion.submit("create", name, url,
+                                       lambda job: self.create_retriever_from_document(name, url, index_params, job))
+
+    def submit_rebuild_retriever(self, name: str, index_params: IndexParams) -> Optional[str]:
+        # перестроение (для IVF-PQ — с повторным эмбеддингом всех фрагментов) идёт фоновой задачей
+        if self.__getitem__(name) is None:
+            logging.error("База знаний %s не найдена", name)
+            return None
+        return self.__ingestion.submit("rebuild", name, "",
+                                       lambda job: self.rebuild_retriever(name, index_params),
+                                       description="index_type={index_type}".format(index_type=index_params.index_type))
+
+    def ingestion_status(self, job_id: str) -> Optional[dict]:
+        return self.__ingestion.status(job_id)
+
+    def ingestion_jobs(self) -> List[dict]:
+        return self.__ingestion.jobs()
+
+    def rebuild_retriever(self, name: str, index_params: IndexParams) -> bool:
+        try:
+            retriever = self.__getitem__(name)
+            with retriever.lock:
+                store: FAISS = self.__open(retriever, writable=True)
+                documents: List[Document] = store_documents(store)
+                vectors: Optional[np.ndarray] = store_vectors(
+                    store, retriever.params)
+                if vectors is None:
+                    vectors = self.__embed_documents(documents)
+                db = build_store(self.__embeddings, documents,
+                                 vectors, index_params)
+                save_params(retriever.path, index_params)
+                retriever.save(db)
+                retriever.replace(db, index_params)
+            self.__invalidate(name)
+            logging.info(
+                "Перестроение базы знаний %s -> %s", name, index_params.index_type)
+            return True
+        except:
+            logging.error("Перестроение базы знаний %s не удалось", name)
+            return False
+
+    def search(self, question: str, embedding: Optional[List[float]] = None) -> List[Tuple[Document, float]]:
+        active: List[Retriever] = [
+            retriever for retriever in self.__retrievers if retriever.status]
+        names: frozenset = frozenset([retriever.name for retriever in active])
+        found: Optional[list] = self.__query_cache.get(question, names)
+        if found is not None:
+            metrics.inc("diplom_query_cache_hits_total")
+            return found
+        version: int = self.__query_cache.version
+        found = []
+        if active:
+            # запрос эмбеддится один раз, поиск идёт параллельно только по активным базам
+            if embedding is None:
+                embedding = self.__embedding_service.embed_query(question)
+            k: int = self.__params.k
+            for results in self.__search_pool.map(lambda retriever: self.__search_in(retriever, embedding, k), active):
+                found.extend(results)
+            threshold: Optional[float] = self.__params.score_threshold
+            found = sorted([result for result in found if threshold is None or result[1] >= threshold],
+                           key=lambda result: result[1], reverse=True)[:k]
+        logging.info(
+            "Найдено фрагментов %s в базах знаний %s", len(found), len(active))
+        self.__query_cache.put(question, names, found, version)
+        return found
+
+    def search_batch(self, questions: List[str]) -> List[List[Tuple[Document, float]]]:
+        # вопросы пакета уходят в сервис эмбеддингов разом и считаются общими проходами
+        if not questions:
+            return []
+        embeddings: List[List[float]] = self.__embedding_service.embed_queries(
+            questions)
+        return [self.search(question, embedding) for question, embedding in zip(questions, embeddings)]
+
+    def __search_in(self, retriever: Retriever, embedding: List[float], k: int) -> List[Tuple[Document, float]]:
+        with metrics.timer("diplom_store_open_seconds", store=retriever.name):
+            store: FAISS = self.__open(retriever)
+        with metrics.timer("diplom_store_search_seconds", store=retriever.name):
+            return retriever.search(store, embedding, k)
+
+    def __call__(self, question: str, embedding: Optional[List[float]] = None):
+        return " ".join([doc.page_content for doc, _ in self.search(question, embedding)])
 
     def __getitem__(self, name: str):
         for retriever in self.__retrievers:
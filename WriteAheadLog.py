@@ -0,0 +1,115 @@
+import os
+import pickle
+import struct
+import zlib
+from threading import Lock
+from typing import Iterator, List
+import numpy as np
+import logging
+
+HEADER = struct.Struct("<QI")
+
+
+class WalRecord:
+    def __init__(self, seq: int, ids: List[str], texts: List[str], metadatas: List[dict], vectors: np.ndarray) -> None:
+        self.seq: int = seq
+        self.ids: List[str] = ids
+        self.texts: List[str] = texts
+        self.metadatas: List[dict] = metadatas
+        self.vectors: np.ndarray = vectors
+
+
+class WriteAheadLog:
+    def __init__(self, path: str, read_only: bool = False, base_seq: int = 0) -> None:
+        self.__path: str = path
+        self.__read_only: bool = read_only
+        self.__lock = Lock()
+        # после сжатия записи до снимка удалены, поэтому нумерация продолжается с номера снимка
+        self.__last_seq: int = base_seq
+        self.__records: int = 0
+        self.__valid_size: int = 0
+        for record in self.__read():
+            self.__last_seq = max(self.__last_seq, record.seq)
+            self.__records += 1
+        # новые записи не должны оказаться за повреждённым хвостом;
+        # читатель не трогает файл — «хвост» может оказаться записью, которую владелец ещё дописывает
+        if not read_only and self.size > self.__valid_size:
+            os.truncate(self.__path, self.__valid_size)
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    @property
+    def last_seq(self) -> int:
+        return self.__last_seq
+
+    @property
+    def records(self) -> int:
+        return self.__records
+
+    @property
+    def size(self) -> int:
+        try:
+            return os.path.getsize(self.__path)
+        except OSError:
+            return 0
+
+    def append(self, ids: List[str], texts: List[str], metadatas: List[dict], vectors: np.ndarray) -> int:
+        if self.__read_only:
+            raise PermissionError("журнал открыт только для чтения")
+        with self.__lock:
+            record = WalRecord(self.__last_seq + 1, ids,
+                               texts, metadatas, vectors)
+            payload: bytes = pickle.dumps(record.__dict__)
+            with open(self.__path, "ab") as file:
+                file.write(HEADER.pack(len(payload), zlib.crc32(payload)))
+                file.write(payload)
+                file.flush()
+                os.fsync(file.fileno())
+            self.__last_seq = record.seq
+            self.__records += 1
+            self.__valid_size = self.size
+            return record.seq
+
+    def replay(self, after_seq: int = 0) -> Iterator[WalRecord]:
+        for record in self.__read():
+            if record.seq > after_seq:
+                yield record
+
+    def truncate(self, through_seq: int) -> None:
+        # записи, попавшие в снимок, удаляются; хвост переписывается в новый файл и подменяет старый
+        if self.__read_only:
+            raise PermissionError("журнал открыт только для чтения")
+        with self.__lock:
+            tail: List[WalRecord] = [
+                record for record in self.__read() if record.seq > through_seq]
+            temporary: str = self.__path + ".tmp"
+            with open(temporary, "wb") as file:
+                for record in tail:
+                    payload: bytes = pickle.dumps(record.__dict__)
+                    file.write(HEADER.pack(len(payload), zlib.crc32(payload)))
+                    file.write(payload)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, self.__path)
+            self.__records = len(tail)
+            self.__valid_size = self.size
+
+    def __read(self) -> Iterator[WalRecord]:
+        if not os.path.exists(self.__path):
+            return
+        with open(self.__path, "rb") as file:
+            while True:
+                header: bytes = file.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    return
+                length, checksum = HEADER.unpack(header)
+                payload: bytes = file.read(length)
+                # оборванная при сбое последняя запись игнорируется
+                if len(payload) < length or zlib.crc32(payload) != checksum:
+                    logging.error(
+                        "Повреждённый хвост журнала %s пропущен", self.__path)
+                    return
+                self.__valid_size = file.tell()
+                yield WalRecord(**pickle.loads(payload))
@@ -0,0 +1,87 @@
+import argparse
+import json
+import os
+import time
+from typing import Iterable, Iterator, List, Set, Tuple
+import logging
+
+
+def parse_questions(lines: Iterable[str], id_field: str = "id", text_field: str = "question") -> List[Tuple[str, str]]:
+    questions: List[Tuple[str, str]] = []
+    for number, line in enumerate(lines):
+        if not line.strip():
+            continue
+        item: dict = json.loads(line)
+        questions.append(
+            (str(item.get(id_field, number)), item[text_field]))
+    return questions
+
+
+def read_questions(path: str, id_field: str = "id", text_field: str = "question") -> List[Tuple[str, str]]:
+    with open(path, "r", encoding="utf-8") as file:
+        return parse_questions(file, id_field, text_field)
+
+
+def completed_ids(path: str) -> Set[str]:
+    # уже записанные ответы пропускаются при перезапуске
+    if not path or not os.path.exists(path):
+        return set()
+    done: Set[str] = set()
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                item: dict = json.loads(line)
+            except json.JSONDecodeError:
+                # строка, оборванная при падении, будет посчитана заново
+                continue
+            if "answer" in item:
+                done.add(str(item["id"]))
+    return done
+
+
+def run_batch(model, questions: List[Tuple[str, str]], output_path: str = "", batch_size: int = 32) -> Iterator[dict]:
+    done: Set[str] = completed_ids(output_path)
+    pending: List[Tuple[str, str]] = [
+        (question_id, question) for question_id, question in questions if question_id not in done]
+    logging.info(
+        "Пакетная обработка: вопросов %s, уже готово %s", len(questions), len(questions) - len(pending))
+    output = open(output_path, "a", encoding="utf-8") if output_path else None
+    try:
+        for result in model.answer_batch(pending, batch_size):
+            if output is not None:
+                output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                output.flush()
+            yield result
+    finally:
+        if output is not None:
+            output.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Ответы на вопросы из JSONL без сохранения чатов")
+    parser.add_argument("input", help="JSONL с вопросами")
+    parser.add_argument("output", help="JSONL с ответами, дописывается при перезапуске")
+    parser.add_argument("--id-field", default="id")
+    parser.add_argument("--text-field", default="question")
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    from log_config import configure_logging
+    from model import TextGenerationModel
+    configure_logging()
+    model = TextGenerationModel()
+    questions: List[Tuple[str, str]] = read_questions(
+        args.input, args.id_field, args.text_field)
+    start: float = time.perf_counter()
+    answered: int = 0
+    for result in run_batch(model, questions, args.output, args.batch_size):
+        answered += 1
+        print(json.dumps(result, ensure_ascii=False), flush=True)
+    seconds: float = time.perf_counter() - start
+    logging.info(
+        "Пакетная обработка завершена: ответов %s за %.1f с", answered, seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import torch
+from transformers import AutoTokenizer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from device import DeviceParams, configure_threads, load_model  # noqa: E402
+from model import GenerationScheduler, ModelParams  # noqa: E402
+from user_template import user_template  # noqa: E402
+
+CONFIGURATIONS = {
+    "fp32": DeviceParams(device="cpu", dtype="float32"),
+    "bf16": DeviceParams(device="cpu", dtype="bfloat16"),
+    "int8": DeviceParams(device="cpu", dtype="float32", quantize=True),
+}
+
+
+def resident_memory() -> int:
+    with open("/proc/self/statm", "r") as file:
+        return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def run(name: str, args: argparse.Namespace) -> dict:
+    params: DeviceParams = CONFIGURATIONS[name]
+    params.intra_op_threads = args.threads
+    configure_threads(params)
+    before: int = resident_memory()
+    start = time.perf_counter()
+    model = load_model(args.model, params)
+    load_seconds = time.perf_counter() - start
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    scheduler = GenerationScheduler(model, tokenizer, max_batch_size=1)
+    prompt: str = user_template.format(
+        chat_name="benchmark", context="The office is open from 9 to 18.", question="When is the office open?")
+    params_greedy = ModelParams(max_new_tokens=args.max_new_tokens, temperature=0)
+    "".join(scheduler.submit(prompt, ModelParams(max_new_tokens=4, temperature=0)))
+    start = time.perf_counter()
+    first_token = 0.0
+    request = scheduler.submit(prompt, params_greedy)
+    for _ in request:
+        if not first_token:
+            first_token = time.perf_counter() - start
+    elapsed = time.perf_counter() - start
+    return {
+        "config": name,
+        "threads": torch.get_num_threads(),
+        "load_seconds": round(load_seconds, 2),
+        "ttft_seconds": round(first_token, 3),
+        "tokens": len(request.tokens),
+        "tokens_per_second": round(len(request.tokens) / elapsed, 2),
+        "model_resident_mb": round((resident_memory() - before) / 2 ** 20, 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="CPU tokens/s and memory for fp32, bf16 and int8")
+    parser.add_argument("--model", default="./model")
+    parser.add_argument("--tokenizer", default="./tokenizer")
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--configs", default="fp32,bf16,int8")
+    parser.add_argument("--config", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.config:
+        print(json.dumps(run(args.config, args)))
+        return
+    # каждая конфигурация в отдельном процессе, чтобы замер памяти не смешивался
+    for name in args.configs.split(","):
+        subprocess.run([sys.executable, os.path.abspath(__file__), "--config", name,
+                        "--model", args.model, "--tokenizer", args.tokenizer,
+                        "--threads", str(args.threads), "--max-new-tokens", str(args.max_new_tokens)],
+                       check=True)
+
+
+if __name__ == "__main__":
+    main()
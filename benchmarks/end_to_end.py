@@ -0,0 +1,216 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from threading import Thread
+from typing import Dict, List
+
+import httpx
+import uvicorn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from stubs import WORDS, build_chats, build_database, build_model, build_tokenizer, synthetic_text  # noqa: E402
+from ChatHandler import ChatHandler  # noqa: E402
+from Chat import Pair  # noqa: E402
+from RetrieverHandler import RetrieverHandler  # noqa: E402
+from device import DeviceParams  # noqa: E402
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def at(percentile: float) -> float:
+        return round(values[min(int(len(values) * percentile), len(values) - 1)], 5)
+    return {"count": len(values), "p50": at(0.5), "p95": at(0.95), "p99": at(0.99)}
+
+
+def read_traffic(path: str) -> List[str]:
+    questions: List[str] = []
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            item: dict = json.loads(line)
+            text: str = item.get("question") or item.get("text") or \
+                " ".join([item.get("title", ""), item.get("body", "")])
+            questions.append(text.strip())
+    return questions
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(app) -> str:
+    port: int = free_port()
+    server = uvicorn.Server(uvicorn.Config(
+        app, host="127.0.0.1", port=port, log_level="warning"))
+    Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return "http://127.0.0.1:{port}".format(port=port)
+
+
+async def replay(url: str, questions: List[str], concurrency: int) -> dict:
+    ttft: List[float] = []
+    inter_token: List[float] = []
+    tokens_per_second: List[float] = []
+    latency: List[float] = []
+    errors: int = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(client: httpx.AsyncClient, question: str) -> None:
+        nonlocal errors
+        async with semaphore:
+            start: float = time.perf_counter()
+            arrivals: List[float] = []
+            async with client.stream("POST", url + "/stream/", json={"text": question}) as response:
+                if response.status_code != 200:
+                    errors += 1
+                    return
+                async for chunk in response.aiter_text():
+                    if chunk:
+                        arrivals.append(time.perf_counter())
+            end: float = time.perf_counter()
+            latency.append(end - start)
+            if not arrivals:
+                return
+            ttft.append(arrivals[0] - start)
+            inter_token.extend(
+                [later - earlier for earlier, later in zip(arrivals, arrivals[1:])])
+            if end > arrivals[0]:
+                tokens_per_second.append(len(arrivals) / (end - arrivals[0]))
+
+    start: float = time.perf_counter()
+    async with httpx.AsyncClient(timeout=None) as client:
+        await asyncio.gather(*[one(client, question) for question in questions])
+    elapsed: float = time.perf_counter() - start
+    return {
+        "requests": len(questions),
+        "errors": errors,
+        "concurrency": concurrency,
+        "requests_per_second": round(len(questions) / elapsed, 3),
+        "ttft": percentiles(ttft),
+        "inter_token_latency": percentiles(inter_token),
+        "tokens_per_second": percentiles(tokens_per_second),
+        "request_latency": percentiles(latency),
+    }
+
+
+def measure_retrieval(database: str, questions: List[str]) -> dict:
+    handler = RetrieverHandler(
+        database, device_params=DeviceParams(device="cpu", dtype="float32", warmup=False))
+    timings: List[float] = []
+    # у каждого вопроса свой суффикс, чтобы кэш запросов не подменял поиск
+    for index, question in enumerate(questions):
+        start: float = time.perf_counter()
+        handler.search("{question} {index}".format(question=question, index=index))
+        timings.append(time.perf_counter() - start)
+    return percentiles(timings)
+
+
+def measure_ingestion(database: str, documents: int, rng: random.Random) -> dict:
+    handler = RetrieverHandler(
+        database, device_params=DeviceParams(device="cpu", dtype="float32", warmup=False))
+    timings: List[float] = []
+    failures: int = 0
+    start: float = time.perf_counter()
+    for _ in range(documents):
+        begin: float = time.perf_counter()
+        # неудачная загрузка возвращает False, её скорость не должна попасть в отчёт
+        if handler.add_text_in_retriever("kb0", synthetic_text(rng, 60)):
+            timings.append(time.perf_counter() - begin)
+        else:
+            failures += 1
+    elapsed: float = time.perf_counter() - start
+    return {"documents_per_second": round(len(timings) / elapsed, 2), "failures": failures,
+            "latency": percentiles(timings)}
+
+
+def measure_chat_save(path: str, backend: str, pairs: int, rng: random.Random) -> dict:
+    handler = ChatHandler(path, backend)
+    id: int = handler.create_chat("benchmark")
+    timings: List[float] = []
+    for _ in range(pairs):
+        pair = Pair(user=synthetic_text(rng, 12), bot=synthetic_text(rng, 40))
+        start: float = time.perf_counter()
+        handler(id).add_pair(pair)
+        timings.append(time.perf_counter() - start)
+    return percentiles(timings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Offline end-to-end benchmark of the FastAPI app on a stub model")
+    parser.add_argument("--traffic", default="./requests.jsonl")
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--concurrency", default="1,4,16")
+    parser.add_argument("--knowledge-bases", type=int, default=4)
+    parser.add_argument("--documents", type=int, default=1000)
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--pairs", type=int, default=10)
+    parser.add_argument("--chats-backend", default="jsonl")
+    parser.add_argument("--hidden-size", type=int, default=64)
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--answer-cache", action="store_true")
+    parser.add_argument("--startup-runs", type=int, default=5)
+    parser.add_argument("--workdir", default="")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    workdir: str = args.workdir or tempfile.mkdtemp(prefix="diplom-bench-")
+    paths: Dict[str, str] = {name: os.path.join(workdir, name)
+                             for name in ("model", "tokenizer", "database", "chats", "chat_save")}
+    traffic: List[str] = read_traffic(args.traffic)
+    questions: List[str] = [traffic[index % len(traffic)]
+                            for index in range(args.requests)]
+
+    tokenizer = build_tokenizer(paths["tokenizer"], traffic + [
+        synthetic_text(rng, 60) for _ in range(200)] + WORDS)
+    build_model(paths["model"], len(tokenizer), args.hidden_size, args.layers, args.seed)
+    build_database(paths["database"], args.knowledge_bases, args.documents, rng)
+    build_chats(paths["chats"], args.chats_backend, args.chats, args.pairs, rng)
+
+    import server
+    from model import TextGenerationModel
+    startup: List[float] = []
+    # запуск измеряется несколько раз, в сервере остаётся модель последнего запуска
+    for _ in range(max(args.startup_runs, 1)):
+        start: float = time.perf_counter()
+        server.txt_model = TextGenerationModel(
+            DeviceParams(device="cpu", dtype="float32", warmup=False),
+            model_path=paths["model"], tokenizer_path=paths["tokenizer"], database_path=paths["database"],
+            chats_path=paths["chats"], chats_backend=args.chats_backend)
+        startup.append(time.perf_counter() - start)
+    server.txt_model.set_model_params(max_new_tokens=args.max_new_tokens)
+    server.txt_model.set_answer_cache_params(enabled=args.answer_cache)
+    url: str = start_server(server.app)
+
+    report: dict = {
+        "config": vars(args),
+        "startup_seconds": percentiles(startup),
+        "load": [asyncio.run(replay(url, questions, int(level))) for level in args.concurrency.split(",")],
+        "retrieval_latency": measure_retrieval(paths["database"], questions),
+        "ingestion": measure_ingestion(paths["database"], min(args.documents, 200), rng),
+        "chat_save_latency": measure_chat_save(paths["chat_save"], args.chats_backend, 200, rng),
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if report["ingestion"]["failures"]:
+        print("ingestion failed for {failures} documents".format(
+            failures=report["ingestion"]["failures"]), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import faiss
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from index_factory import IndexParams, build_index  # noqa: E402
+
+
+def clustered_vectors(count: int, dimension: int, clusters: int, seed: int) -> np.ndarray:
+    # эмбеддинги текстов кластеризованы, равномерный шум дал бы заниженный recall
+    generator = np.random.default_rng(seed)
+    centers = generator.normal(size=(clusters, dimension)).astype(np.float32)
+    labels = generator.integers(0, clusters, size=count)
+    vectors = centers[labels] + 0.3 * \
+        generator.normal(size=(count, dimension)).astype(np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def measure(index: faiss.Index, queries: np.ndarray, k: int, truth: np.ndarray) -> dict:
+    start = time.perf_counter()
+    _, found = index.search(queries, k)
+    elapsed = time.perf_counter() - start
+    recall = np.mean([len(set(found[row]) & set(truth[row])) / k
+                      for row in range(len(queries))])
+    return {
+        "recall_at_k": round(float(recall), 4),
+        "latency_ms_per_query": round(1000 * elapsed / len(queries), 4),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Recall and latency of ANN index types against the flat baseline")
+    parser.add_argument("--count", type=int, default=200000)
+    parser.add_argument("--dimension", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--nprobe", default="1,4,16,64")
+    parser.add_argument("--ef-search", default="16,64,256")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    vectors = clustered_vectors(
+        args.count + args.queries, args.dimension, 256, args.seed)
+    base, queries = vectors[:args.count], vectors[args.count:]
+
+    flat = build_index(base, IndexParams(index_type="flat"))
+    flat.add(base)
+    _, truth = flat.search(queries, args.k)
+    print(json.dumps({"index_type": "flat", **measure(flat, queries, args.k, truth)}))
+
+    configurations = [IndexParams(index_type="hnsw", ef_search=int(ef_search))
+                      for ef_search in args.ef_search.split(",")]
+    for index_type in ("ivf_flat", "ivf_pq"):
+        configurations += [IndexParams(index_type=index_type, nprobe=int(nprobe))
+                           for nprobe in args.nprobe.split(",")]
+    built = {}
+    for params in configurations:
+        # индекс одного типа строится один раз, параметры поиска меняются на лету
+        if params.index_type not in built:
+            start = time.perf_counter()
+            built[params.index_type] = build_index(base, params)
+            built[params.index_type].add(base)
+            build_seconds = round(time.perf_counter() - start, 2)
+        index = built[params.index_type]
+        if params.index_type == "hnsw":
+            index.hnsw.efSearch = params.ef_search
+        else:
+            faiss.extract_index_ivf(index).nprobe = params.nprobe
+        print(json.dumps({"index_type": params.index_type, "nprobe": params.nprobe, "ef_search": params.ef_search,
+                          "build_seconds": build_seconds, **measure(index, queries, args.k, truth)}))
+
+
+if __name__ == "__main__":
+    main()
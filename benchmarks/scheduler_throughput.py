@@ -0,0 +1,81 @@
+import argparse
+import json
+import os
+import sys
+import time
+from threading import Thread
+from typing import List
+
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model import GenerationScheduler, ModelParams  # noqa: E402
+from user_template import user_template  # noqa: E402
+
+
+def run_level(scheduler: GenerationScheduler, concurrency: int, params: ModelParams) -> dict:
+    prompts: List[str] = [
+        user_template.format(
+            chat_name="benchmark",
+            context="Document number {index} describes the vacation policy.".format(
+                index=index),
+            question="Summarize the vacation policy, question {index}.".format(
+                index=index)
+        )
+        for index in range(concurrency)
+    ]
+    token_counts: List[int] = [0] * concurrency
+    first_token: List[float] = [0.0] * concurrency
+
+    def worker(index: int) -> None:
+        request = scheduler.submit(prompts[index], params)
+        for _ in request:
+            if not first_token[index]:
+                first_token[index] = time.perf_counter() - start
+        token_counts[index] = len(request.tokens)
+
+    threads = [Thread(target=worker, args=(index,))
+               for index in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "tokens": sum(token_counts),
+        "seconds": round(elapsed, 3),
+        "tokens_per_second": round(sum(token_counts) / elapsed, 2),
+        "mean_ttft": round(sum(first_token) / concurrency, 3),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Aggregate tokens/s of GenerationScheduler against concurrency")
+    parser.add_argument("--model", default="./model")
+    parser.add_argument("--tokenizer", default="./tokenizer")
+    parser.add_argument("--device", default="cuda:0")
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--levels", default="1,2,4,8,16")
+    args = parser.parse_args()
+
+    model = AutoModelForCausalLM.from_pretrained(
+        args.model,
+        torch_dtype=torch.bfloat16 if args.device.startswith("cuda") else torch.float32
+    ).to(args.device).eval()
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    scheduler = GenerationScheduler(model, tokenizer, args.max_batch_size)
+    params = ModelParams(max_new_tokens=args.max_new_tokens)
+
+    # прогрев, чтобы первый уровень не включал инициализацию CUDA
+    run_level(scheduler, 1, ModelParams(max_new_tokens=8))
+    for level in [int(level) for level in args.levels.split(",")]:
+        print(json.dumps(run_level(scheduler, level, params)))
+
+
+if __name__ == "__main__":
+    main()
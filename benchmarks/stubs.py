@@ -0,0 +1,99 @@
+import hashlib
+import os
+import random
+import re
+import sys
+from typing import List
+
+import numpy as np
+import torch
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ChatStorage import create_chat_storage  # noqa: E402
+from RetrieverHandler import Retriever  # noqa: E402
+from index_factory import IndexParams, build_store, save_params  # noqa: E402
+
+WORDS: List[str] = (
+    "office vacation policy salary report contract manager employee schedule project "
+    "deadline meeting budget invoice security access password server backup network "
+    "training document approval request holiday insurance travel expense laptop license"
+).split()
+
+
+class HashEmbeddings(Embeddings):
+    # детерминированные эмбеддинги без весов: мешок слов, разложенный по хэшам
+    def __init__(self, size: int = 256) -> None:
+        self.size: int = size
+
+    def __embed(self, text: str) -> List[float]:
+        vector: np.ndarray = np.zeros(self.size, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            digest: int = int.from_bytes(hashlib.md5(
+                word.encode("utf-8")).digest()[:4], "little")
+            vector[digest % self.size] += 1.0 if digest & 1 << 31 else -1.0
+        norm: float = float(np.linalg.norm(vector))
+        return (vector / norm if norm > 0 else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.__embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.__embed(text)
+
+
+def synthetic_text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def build_tokenizer(path: str, texts: List[str], vocab_size: int = 512):
+    # маленький byte-level BPE, обученный на синтетическом корпусе
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.train_from_iterator(texts, trainers.BpeTrainer(
+        vocab_size=vocab_size, special_tokens=["<s>", "</s>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()))
+    fast = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>")
+    fast.save_pretrained(path)
+    return fast
+
+
+def build_model(path: str, vocab_size: int, hidden_size: int = 64, layers: int = 2, seed: int = 0) -> None:
+    # случайные веса: скорость и работа с KV те же, что у настоящей модели, качество не важно
+    from transformers import LlamaConfig, LlamaForCausalLM
+    torch.manual_seed(seed)
+    config = LlamaConfig(vocab_size=vocab_size, hidden_size=hidden_size, intermediate_size=hidden_size * 2,
+                         num_hidden_layers=layers, num_attention_heads=4, num_key_value_heads=4,
+                         max_position_embeddings=4096, bos_token_id=0, eos_token_id=1)
+    LlamaForCausalLM(config).save_pretrained(path)
+
+
+def build_database(path: str, knowledge_bases: int, documents: int, rng: random.Random) -> None:
+    embeddings = HashEmbeddings()
+    os.makedirs(os.path.join(path, "embeddings"), exist_ok=True)
+    os.makedirs(os.path.join(path, "knowladge"), exist_ok=True)
+    torch.save(embeddings, os.path.join(path, "embeddings", "embeddings.pt"))
+    params = IndexParams()
+    for index in range(knowledge_bases):
+        texts: List[str] = [synthetic_text(rng, 60) for _ in range(documents)]
+        store = build_store(embeddings, [Document(text) for text in texts],
+                            np.array(embeddings.embed_documents(texts), dtype=np.float32), params)
+        retriever = Retriever("kb{index}".format(index=index),
+                              os.path.join(path, "knowladge"), embeddings, params=params)
+        os.makedirs(retriever.path, exist_ok=True)
+        save_params(retriever.path, params)
+        retriever.save(store)
+
+
+def build_chats(path: str, backend: str, chats: int, pairs: int, rng: random.Random) -> None:
+    os.makedirs(path, exist_ok=True)
+    storage = create_chat_storage(path, backend)
+    for id in range(chats):
+        storage.import_chat(id, synthetic_text(rng, 4), [
+            {"user": synthetic_text(rng, 12), "bot": synthetic_text(rng, 40)} for _ in range(pairs)])
+    storage.flush()
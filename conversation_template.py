@@ -0,0 +1,18 @@
+conversation_template = '''
+<|system|>
+You are a friendly chatbot who tries to help the user. If you DO NOT know answer, then say that you don't know answer. 
+Use the chat name {chat_name} and the context given after each question to answer it. </s>
+'''
+
+conversation_turn_template = '''<|user|>
+{question}</s>
+<|assistant|>
+{answer}</s>
+'''
+
+conversation_question_template = '''<|user|>
+{question}</s>
+<|system|>
+{context} </s>
+<|assistant|>
+'''
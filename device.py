@@ -0,0 +1,98 @@
+import importlib.util
+import os
+import torch
+from pydantic import BaseModel
+import logging
+
+DTYPES = {
+    "float32": torch.float32,
+    "bfloat16": torch.bfloat16,
+    "float16": torch.float16,
+}
+
+
+class DeviceParams(BaseModel):
+    device: str = "cuda:0" if torch.cuda.is_available() else "cpu"
+    dtype: str = "bfloat16"
+    quantize: bool = False
+    intra_op_threads: int = 0
+    inter_op_threads: int = 0
+    warmup: bool = True
+
+    @classmethod
+    def from_env(cls) -> "DeviceParams":
+        params = cls()
+        params.device = os.environ.get("DIPLOM_DEVICE", params.device)
+        params.dtype = os.environ.get("DIPLOM_DTYPE", params.dtype)
+        params.quantize = os.environ.get(
+            "DIPLOM_QUANTIZE", str(params.quantize)).lower() in ("1", "true", "yes")
+        params.intra_op_threads = int(os.environ.get(
+            "DIPLOM_INTRA_OP_THREADS", params.intra_op_threads))
+        params.inter_op_threads = int(os.environ.get(
+            "DIPLOM_INTER_OP_THREADS", params.inter_op_threads))
+        params.warmup = os.environ.get(
+            "DIPLOM_WARMUP", str(params.warmup)).lower() in ("1", "true", "yes")
+        return params
+
+    @property
+    def on_cpu(self) -> bool:
+        return self.device == "cpu"
+
+    @property
+    def quantized(self) -> bool:
+        # динамическая int8-квантизация torch работает только на CPU
+        return self.quantize and self.on_cpu
+
+    @property
+    def torch_dtype(self) -> torch.dtype:
+        return torch.float32 if self.quantized else DTYPES[self.dtype]
+
+
+def configure_threads(params: DeviceParams) -> None:
+    if params.intra_op_threads > 0:
+        torch.set_num_threads(params.intra_op_threads)
+    if params.inter_op_threads > 0:
+        try:
+            torch.set_num_interop_threads(params.inter_op_threads)
+        except RuntimeError:
+            # число inter-op потоков можно задать только до первого параллельного вызова
+            logging.error("Число inter-op потоков уже зафиксировано")
+    logging.info(
+        "Потоки torch: intra-op %s, inter-op %s", torch.get_num_threads(), torch.get_num_interop_threads())
+
+
+def quantize_module(module: torch.nn.Module) -> torch.nn.Module:
+    return torch.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def load_model(path: str, params: DeviceParams) -> torch.nn.Module:
+    from transformers import AutoModelForCausalLM
+    # safetensors отображаются в память, веса не копируются и не инициализируются случайно перед загрузкой
+    safetensors: bool = any(file.endswith(".safetensors")
+                            for file in os.listdir(path))
+    # без accelerate transformers 4.4x отказывается грузить с low_cpu_mem_usage, тогда грузим обычным путём
+    low_cpu_mem_usage: bool = importlib.util.find_spec("accelerate") is not None
+    if not low_cpu_mem_usage:
+        logging.warning("accelerate не установлен, модель загружается без low_cpu_mem_usage")
+    model = AutoModelForCausalLM.from_pretrained(
+        path,
+        torch_dtype=params.torch_dtype,
+        use_safetensors=safetensors or None,
+        low_cpu_mem_usage=low_cpu_mem_usage
+    ).to(params.device).eval()
+    if params.quantized:
+        logging.info("Квантизация модели в int8")
+        model = quantize_module(model)
+    return model
+
+
+def load_embeddings(path: str, params: DeviceParams):
+    embeddings = torch.load(
+        path, map_location=torch.device(params.device), weights_only=False)
+    client = getattr(embeddings, "client", None)
+    if isinstance(client, torch.nn.Module):
+        client.to(params.device)
+        if params.quantized:
+            logging.info("Квантизация модели эмбеддинга в int8")
+            embeddings.client = quantize_module(client)
+    return embeddings
@@ -0,0 +1,143 @@
+import json
+import math
+import os
+from typing import List, Optional
+
+import faiss
+import numpy as np
+from pydantic import BaseModel
+from langchain.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_core.documents import Document
+
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+INDEX_PARAMS_FILE = "index_params.json"
+
+
+class IndexParams(BaseModel):
+    index_type: str = "flat"
+    nlist: int = 0
+    nprobe: int = 8
+    hnsw_m: int = 32
+    ef_construction: int = 64
+    ef_search: int = 64
+    pq_m: int = 0
+    pq_bits: int = 8
+
+
+def choose_nlist(params: IndexParams, count: int) -> int:
+    nlist: int = params.nlist or int(4 * math.sqrt(count))
+    return max(1, min(nlist, count))
+
+
+def choose_pq_m(params: IndexParams, dimension: int) -> int:
+    if params.pq_m and dimension % params.pq_m == 0:
+        return params.pq_m
+    for pq_m in (64, 48, 32, 24, 16, 12, 8, 4, 2, 1):
+        if pq_m <= dimension // 2 and dimension % pq_m == 0:
+            return pq_m
+    return 1
+
+
+def build_index(vectors: np.ndarray, params: IndexParams) -> faiss.Index:
+    if params.index_type not in INDEX_TYPES:
+        raise ValueError("unknown index type {index_type}".format(
+            index_type=params.index_type))
+    count, dimension = vectors.shape
+    if params.index_type == "flat":
+        index = faiss.IndexFlatL2(dimension)
+    elif params.index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, params.hnsw_m)
+        index.hnsw.efConstruction = params.ef_construction
+    else:
+        quantizer = faiss.IndexFlatL2(dimension)
+        nlist: int = choose_nlist(params, count)
+        if params.index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dimension, nlist)
+        else:
+            # для обучения PQ нужно не меньше 2^bits векторов
+            pq_bits: int = max(1, min(params.pq_bits, int(math.log2(max(count, 2)))))
+            index = faiss.IndexIVFPQ(
+                quantizer, dimension, nlist, choose_pq_m(params, dimension), pq_bits)
+        # обучение на загружаемых векторах
+        index.train(vectors)
+    apply_search_params(index, params)
+    return index
+
+
+def apply_search_params(index: faiss.Index, params: IndexParams) -> None:
+    if params.index_type == "hnsw":
+        index.hnsw.efSearch = params.ef_search
+    elif params.index_type in ("ivf_flat", "ivf_pq"):
+        faiss.extract_index_ivf(index).nprobe = params.nprobe
+
+
+def training_size(params: IndexParams) -> int:
+    if params.index_type in ("ivf_flat", "ivf_pq"):
+        return params.nlist * 39 if params.nlist else 4096
+    return 0
+
+
+def add_vectors(store: FAISS, documents: List[Document], vectors: np.ndarray) -> None:
+    store.add_embeddings(
+        zip([document.page_content for document in documents], vectors.tolist()),
+        metadatas=[document.metadata for document in documents]
+    )
+
+
+def build_store(embeddings, documents: List[Document], vectors: np.ndarray, params: IndexParams) -> FAISS:
+    if not documents:
+        raise ValueError("no documents to index")
+    store = FAISS(embeddings, build_index(vectors, params),
+                  InMemoryDocstore(), {})
+    add_vectors(store, documents, vectors)
+    return store
+
+
+def store_documents(store: FAISS) -> List[Document]:
+    return [store.docstore.search(store.index_to_docstore_id[position]) for position in range(store.index.ntotal)]
+
+
+def store_vectors(store: FAISS, params: IndexParams) -> Optional[np.ndarray]:
+    # PQ хранит векторы с потерями, такой индекс перестраивается с повторным эмбеддингом
+    if params.index_type == "ivf_pq":
+        return None
+    # плоский индекс в снимке тоже записан как IVF с одним списком
+    if is_ivf(store.index):
+        faiss.extract_index_ivf(store.index).make_direct_map()
+    return store.index.reconstruct_n(0, store.index.ntotal)
+
+
+def is_ivf(index: faiss.Index) -> bool:
+    try:
+        faiss.extract_index_ivf(index)
+        return True
+    except RuntimeError:
+        return False
+
+
+def shareable_index(index: faiss.Index) -> faiss.Index:
+    # faiss отображает в память только инвертированные списки, поэтому плоский индекс
+    # записывается как IVF с единственным списком: поиск по нему остаётся точным перебором
+    if not isinstance(index, faiss.IndexFlat):
+        return index
+    quantizer = faiss.IndexFlat(index.d, index.metric_type)
+    quantizer.add(np.zeros((1, index.d), dtype=np.float32))
+    ivf = faiss.IndexIVFFlat(quantizer, index.d, 1, index.metric_type)
+    ivf.is_trained = True
+    if index.ntotal:
+        ivf.add(index.reconstruct_n(0, index.ntotal))
+    return ivf
+
+
+def save_params(path: str, params: IndexParams) -> None:
+    with open(os.path.join(path, INDEX_PARAMS_FILE), "w", encoding="utf-8") as file:
+        file.write(json.dumps(params.dict(), ensure_ascii=False))
+
+
+def load_params(path: str) -> IndexParams:
+    try:
+        with open(os.path.join(path, INDEX_PARAMS_FILE), "r", encoding="utf-8") as file:
+            return IndexParams(**json.load(file))
+    except FileNotFoundError:
+        return IndexParams()
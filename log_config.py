@@ -0,0 +1,28 @@
+import atexit
+import logging
+import logging.handlers
+from queue import SimpleQueue
+from typing import Optional
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(message)s"
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def configure_logging(filename: str = "py_log.log", level: int = logging.INFO) -> None:
+    # запись в файл идёт в отдельном потоке, обработчик запроса только кладёт запись в очередь
+    global _listener
+    if _listener is not None:
+        return
+    queue: SimpleQueue = SimpleQueue()
+    file_handler = logging.FileHandler(filename, mode="a", encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(queue))
+    _listener = logging.handlers.QueueListener(
+        queue, file_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
@@ -0,0 +1,126 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from typing import Callable, Dict, Iterator, List, Tuple
+import json
+import time
+import logging
+
+BUCKETS: Tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                              0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS) -> None:
+        self.buckets: Tuple[float, ...] = buckets
+        self.counts: List[int] = [0] * (len(buckets) + 1)
+        self.sum: float = 0.0
+        self.count: int = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.__lock = Lock()
+        self.__counters: Dict[Tuple[str, Tuple], float] = {}
+        self.__histograms: Dict[Tuple[str, Tuple], Histogram] = {}
+        self.__collectors: List[Callable[[], Dict[str, float]]] = []
+
+    @staticmethod
+    def __key(name: str, labels: dict) -> Tuple[str, Tuple]:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        key = self.__key(name, labels)
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = self.__key(name, labels)
+        with self.__lock:
+            histogram = self.__histograms.get(key)
+            if histogram is None:
+                histogram = self.__histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        start: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def add_collector(self, collector: Callable[[], Dict[str, float]]) -> None:
+        # значения, которые дешевле снять в момент запроса /metrics, чем считать постоянно
+        self.__collectors.append(collector)
+
+    @staticmethod
+    def __labels(labels: Tuple, extra: str = "") -> str:
+        parts: List[str] = ['{name}="{value}"'.format(name=name, value=str(value).replace('"', '\\"'))
+                            for name, value in labels]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        lines: List[str] = []
+        with self.__lock:
+            for (name, labels), value in sorted(self.__counters.items()):
+                lines.append("{name}{labels} {value}".format(
+                    name=name, labels=self.__labels(labels), value=value))
+            for (name, labels), histogram in sorted(self.__histograms.items()):
+                cumulative: int = 0
+                for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    lines.append("{name}_bucket{labels} {value}".format(
+                        name=name, value=cumulative,
+                        labels=self.__labels(labels, 'le="{bound}"'.format(
+                            bound="+Inf" if bound == float("inf") else bound))))
+                lines.append("{name}_sum{labels} {value}".format(
+                    name=name, labels=self.__labels(labels), value=histogram.sum))
+                lines.append("{name}_count{labels} {value}".format(
+                    name=name, labels=self.__labels(labels), value=histogram.count))
+        for collector in self.__collectors:
+            try:
+                for name, value in collector().items():
+                    lines.append("{name} {value}".format(name=name, value=value))
+            except Exception as error:
+                logging.error("Сбор метрик не удался: %s", error)
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class Trace:
+    def __init__(self, kind: str) -> None:
+        self.kind: str = kind
+        self.spans: Dict[str, float] = {}
+        self.__start: float = time.perf_counter()
+
+    def add(self, stage: str, seconds: float, **labels) -> None:
+        self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+        metrics.observe("diplom_stage_seconds", seconds,
+                        kind=self.kind, stage=stage, **labels)
+
+    @contextmanager
+    def span(self, stage: str, **labels) -> Iterator[None]:
+        start: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, **labels)
+
+    def finish(self, **fields) -> None:
+        total: float = time.perf_counter() - self.__start
+        metrics.observe("diplom_request_seconds", total, kind=self.kind)
+        metrics.inc("diplom_requests_total", kind=self.kind)
+        logging.info("trace %s", json.dumps({
+            "kind": self.kind, "total": round(total, 5),
+            "spans": {stage: round(seconds, 5) for stage, seconds in self.spans.items()}, **fields},
+            ensure_ascii=False))
@@ -1,16 +1,35 @@
 import torch
+import torch.nn.functional as F
+from queue import Queue, PriorityQueue, Empty
+from itertools import count
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import re
+import os
+import time
+from threading import Thread, Lock, Event
+from collections import OrderedDict, deque
+from typing import Dict, Iterator, List, Optional, Tuple
 from RetrieverHandler import RetrieverHandler
+from AnswerCache import AnswerCache
+from PromptBuilder import PromptBuilder, PromptParams
+from metrics import Trace, metrics
+from index_factory import IndexParams
 from ChatHandler import ChatHandler
 from Chat import Pair
-from transformers import AutoTokenizer, pipeline, AutoModelForCausalLM, TextStreamer
+from transformers import AutoTokenizer, DynamicCache
+from device import DeviceParams, configure_threads, load_model
 from user_template import user_template
 from chat_template import chat_template
+from conversation_template import conversation_template, conversation_turn_template, conversation_question_template
 from pydantic import BaseModel
 import logging
-logging.basicConfig(level=logging.INFO, filename="py_log.log",  filemode="a",
-                    format="%(asctime)s %(levelname)s %(message)s")
 
 chats_path = "./chats"
+chats_backend = "jsonl"
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_CHAT_NAME = 1
+PRIORITY_BATCH = 2
 
 
 class ModelParams(BaseModel):
@@ -20,17 +39,674 @@ class ModelParams(BaseModel):
     top_p: float = 0.95
 
 
-class TextGenerationModel:
+class SpeculativeParams(BaseModel):
+    enabled: bool = False
+    draft_path: str = "./draft_model"
+    num_tokens: int = 4
+
+
+class AnswerCacheParams(BaseModel):
+    enabled: bool = True
+    threshold: float = 0.92
+
+
+class CancellationParams(BaseModel):
+    save_partial: bool = False
+    timeout: float = 300.0
+
+
+class SessionParams(BaseModel):
+    enabled: bool = False
+    max_sessions: int = 64
+    memory_budget_mb: int = 2048
+
+
+def to_legacy_cache(past_key_values) -> tuple:
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return tuple(past_key_values)
+
+
+def to_model_cache(past_key_values: tuple):
+    return DynamicCache.from_legacy_cache(past_key_values)
+
+
+def pad_cache_left(past_key_values: tuple, attention_mask: torch.Tensor, size: int) -> Tuple[tuple, torch.Tensor]:
+    if size == 0:
+        return past_key_values, attention_mask
+    return (
+        tuple((F.pad(key, (0, 0, size, 0)), F.pad(value, (0, 0, size, 0)))
+              for key, value in past_key_values),
+        F.pad(attention_mask, (size, 0))
+    )
+
+
+def merge_caches(first: tuple, first_mask: torch.Tensor, second: tuple, second_mask: torch.Tensor) -> Tuple[tuple, torch.Tensor]:
+    length: int = max(first_mask.shape[1], second_mask.shape[1])
+    first, first_mask = pad_cache_left(
+        first, first_mask, length - first_mask.shape[1])
+    second, second_mask = pad_cache_left(
+        second, second_mask, length - second_mask.shape[1])
+    return (
+        tuple((torch.cat([first_key, second_key]), torch.cat([first_value, second_value]))
+              for (first_key, first_value), (second_key, second_value) in zip(first, second)),
+        torch.cat([first_mask, second_mask])
+    )
+
+
+def select_cache_rows(past_key_values: tuple, attention_mask: torch.Tensor, rows: List[int]) -> Tuple[tuple, torch.Tensor]:
+    index = torch.tensor(rows, device=attention_mask.device)
+    attention_mask = attention_mask.index_select(0, index)
+    # столбцы, которые остались паддингом у всех последовательностей, больше не нужны
+    start: int = int((attention_mask.sum(dim=0) == 0).long().cumprod(0).sum())
+    return (
+        tuple((key.index_select(0, index)[:, :, start:], value.index_select(0, index)[:, :, start:])
+              for key, value in past_key_values),
+        attention_mask[:, start:]
+    )
+
+
+def warp_probabilities(logits: torch.Tensor, params: ModelParams) -> torch.Tensor:
+    if params.temperature <= 0:
+        return F.one_hot(logits.argmax(), logits.shape[-1]).float()
+    logits = logits.float() / params.temperature
+    if 0 < params.top_k < logits.shape[-1]:
+        threshold = torch.topk(logits, params.top_k).values[-1]
+        logits = logits.masked_fill(logits < threshold, float("-inf"))
+    if 0 < params.top_p < 1:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+        cumulative = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+        remove = cumulative > params.top_p
+        remove[1:] = remove[:-1].clone()
+        remove[0] = False
+        logits = logits.masked_fill(
+            remove.scatter(0, sorted_indices, remove), float("-inf"))
+    return logits.softmax(dim=-1)
+
+
+def sample_token(logits: torch.Tensor, params: ModelParams) -> int:
+    if params.temperature <= 0:
+        return int(logits.argmax())
+    return int(torch.multinomial(warp_probabilities(logits, params), 1))
+
+
+def model_forward(model, input_ids: List[int], past_key_values: Optional[tuple]) -> Tuple[torch.Tensor, tuple]:
+    outputs = model(
+        input_ids=torch.tensor([input_ids], device=model.device),
+        past_key_values=None if past_key_values is None else to_model_cache(
+            past_key_values),
+        use_cache=True
+    )
+    return outputs.logits[0], to_legacy_cache(outputs.past_key_values)
+
+
+def cache_length(past_key_values: tuple) -> int:
+    return past_key_values[0][0].shape[2]
+
+
+def template_prefix(template: str) -> str:
+    return template[:template.index("{")]
+
+
+class PrefixCache:
+    def __init__(self) -> None:
+        self.__prefixes: Dict[Tuple[int, ...], Optional[tuple]] = dict()
+
+    def register(self, token_ids: List[int]) -> None:
+        self.__prefixes.setdefault(tuple(token_ids), None)
+
+    def match(self, input_ids: List[int]) -> Tuple[int, ...]:
+        best: Tuple[int, ...] = ()
+        for prefix in self.__prefixes:
+            if len(best) < len(prefix) < len(input_ids) and tuple(input_ids[:len(prefix)]) == prefix:
+                best = prefix
+        return best
+
+    def get(self, prefix: Tuple[int, ...]) -> Optional[tuple]:
+        return self.__prefixes.get(prefix)
+
+    def put(self, prefix: Tuple[int, ...], past_key_values: tuple) -> None:
+        self.__prefixes[prefix] = past_key_values
+
+
+def cache_size(past_key_values: tuple) -> int:
+    return sum(key.element_size() * key.nelement() + value.element_size() * value.nelement()
+               for key, value in past_key_values)
+
+
+def crop_cache(past_key_values: tuple, length: int) -> tuple:
+    return tuple((key[:, :, :length], value[:, :, :length]) for key, value in past_key_values)
+
+
+def common_prefix_length(first: Tuple[int, ...], second: List[int]) -> int:
+    length: int = 0
+    for first_id, second_id in zip(first, second):
+        if first_id != second_id:
+            break
+        length += 1
+    return length
+
+
+class SessionCache:
+    def __init__(self, params: SessionParams) -> None:
+        self.__params: SessionParams = params
+        self.__sessions: OrderedDict = OrderedDict()
+        self.__size: int = 0
+        self.__lock = Lock()
+
+    @property
+    def status(self) -> dict:
+        return {"sessions": len(self.__sessions), "size_bytes": self.__size}
+
+    def match(self, session: int, input_ids: List[int]) -> Tuple[int, Optional[tuple]]:
+        with self.__lock:
+            if session not in self.__sessions:
+                return 0, None
+            self.__sessions.move_to_end(session)
+            token_ids, past_key_values, _ = self.__sessions[session]
+        # хотя бы один токен нужно предзаполнить, чтобы получить логиты
+        length: int = min(common_prefix_length(
+            token_ids, input_ids), len(input_ids) - 1)
+        if length <= 0:
+            return 0, None
+        return length, crop_cache(past_key_values, length)
+
+    def put(self, session: int, token_ids: List[int], past_key_values: tuple) -> None:
+        size: int = cache_size(past_key_values)
+        with self.__lock:
+            self.__remove(session)
+            self.__sessions[session] = (
+                tuple(token_ids), past_key_values, size)
+            self.__size += size
+            # вытеснение давно не использованных сессий по количеству и бюджету памяти
+            while self.__sessions and (len(self.__sessions) > self.__params.max_sessions or
+                                       self.__size > self.__params.memory_budget_mb * 1024 * 1024):
+                evicted, _ = next(iter(self.__sessions.items()))
+                self.__remove(evicted)
+                logging.info("Сессия чата %s вытеснена из кэша", evicted)
+
+    def remove(self, session: int) -> None:
+        with self.__lock:
+            self.__remove(session)
+
+    def __remove(self, session: int) -> None:
+        if session in self.__sessions:
+            self.__size -= self.__sessions.pop(session)[2]
+
+
+class GenerationRequest:
+    def __init__(self, input_ids: List[int], params: ModelParams, session: Optional[int] = None,
+                 cancel_event: Optional[Event] = None, timeout: Optional[float] = None) -> None:
+        self.input_ids: List[int] = input_ids
+        self.params: ModelParams = params
+        self.session: Optional[int] = session
+        self.cancel_event: Event = cancel_event or Event()
+        self.deadline: Optional[float] = None if timeout is None else time.monotonic() + timeout
+        self.cancelled: bool = False
+        self.created_at: float = time.perf_counter()
+        self.queue_seconds: float = 0.0
+        self.prefill_seconds: float = 0.0
+        self.first_token_at: float = 0.0
+        self.decode_seconds: float = 0.0
+        self.ids: List[int] = []
+        self.target_past: Optional[tuple] = None
+        self.draft_past: Optional[tuple] = None
+        self.tokens: List[int] = []
+        self.printed: int = 0
+        self.__queue: Queue = Queue()
+
+    def put(self, item) -> None:
+        self.__queue.put(item)
+
+    def cancel(self) -> None:
+        self.cancel_event.set()
+
+    @property
+    def should_stop(self) -> bool:
+        return self.cancel_event.is_set() or (self.deadline is not None and time.monotonic() > self.deadline)
+
+    def __iter__(self):
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+class SpeculativeStats:
     def __init__(self) -> None:
-        self.__retriever_handler: RetrieverHandler = RetrieverHandler()
-        self.__chats_handler: ChatHandler = ChatHandler(chats_path)
-        self._model_pipeline = self.__load_model()
+        self.steps: int = 0
+        self.proposed: int = 0
+        self.accepted: int = 0
+        self.emitted: int = 0
+        self.seconds: float = 0.0
+        self.decode_tokens: int = 0
+        self.decode_seconds: float = 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "steps": self.steps,
+            "proposed": self.proposed,
+            "accepted": self.accepted,
+            "acceptance_rate": self.accepted / self.proposed if self.proposed else 0.0,
+            "tokens_per_target_pass": self.emitted / self.steps if self.steps else 0.0,
+            "speculative_tokens_per_second": self.emitted / self.seconds if self.seconds else 0.0,
+            "regular_tokens_per_second": self.decode_tokens / self.decode_seconds if self.decode_seconds else 0.0,
+        }
+
+
+class GenerationScheduler:
+    def __init__(self, model, tokenizer, max_batch_size: int = 8, session_params: Optional[SessionParams] = None,
+                 draft_model=None, speculative_tokens: int = 4) -> None:
+        self.__model = model
+        self.__tokenizer = tokenizer
+        self.__max_batch_size: int = max_batch_size
+        self.__draft_model = draft_model
+        self.__speculative_tokens: int = speculative_tokens
+        self.__speculative_enabled: bool = False
+        self.__speculative: List[GenerationRequest] = []
+        self.__speculative_stats: SpeculativeStats = SpeculativeStats()
+        if draft_model is not None:
+            self.__vocab_size: int = min(
+                model.config.vocab_size, draft_model.config.vocab_size)
+        self.__eos_token_ids: set = self.__collect_eos_token_ids()
+        self.__prefix_cache: PrefixCache = PrefixCache()
+        self.__session_cache: SessionCache = SessionCache(
+            session_params or SessionParams())
+        self.__pending: PriorityQueue = PriorityQueue()
+        self.__order = count()
+        self.__active: List[GenerationRequest] = []
+        self.__cancelled_count: int = 0
+        self.__past_key_values: Optional[tuple] = None
+        self.__attention_mask: Optional[torch.Tensor] = None
+        self.__thread = Thread(target=self.__loop, daemon=True)
+        self.__thread.start()
+
+    @property
+    def cancelled_count(self) -> int:
+        return self.__cancelled_count
+
+    @property
+    def active_count(self) -> int:
+        return len(self.__active) + len(self.__speculative)
+
+    @property
+    def speculative_stats(self) -> dict:
+        return {"enabled": self.__speculative_enabled, "draft_loaded": self.__draft_model is not None,
+                **self.__speculative_stats.to_dict()}
+
+    def set_speculative(self, enabled: bool) -> bool:
+        if enabled and self.__draft_model is None:
+            return False
+        self.__speculative_enabled = enabled
+        return True
+
+    @property
+    def pending_count(self) -> int:
+        return self.__pending.qsize()
+
+    @property
+    def session_status(self) -> dict:
+        return self.__session_cache.status
+
+    @property
+    def busy(self) -> bool:
+        return self.active_count + self.pending_count >= self.__max_batch_size
+
+    def submit(self, prompt: str, params: ModelParams, session: Optional[int] = None,
+               priority: int = PRIORITY_INTERACTIVE, cancel_event: Optional[Event] = None,
+               timeout: Optional[float] = None) -> GenerationRequest:
+        request = GenerationRequest(
+            self.__tokenizer.encode(prompt), params, session, cancel_event, timeout)
+        # при равном приоритете порядок поступления сохраняется
+        self.__pending.put((priority, next(self.__order), request))
+        return request
+
+    def store_session(self, session: int, prompt: str) -> GenerationRequest:
+        # запрос без генерации: только дозаполняет KV сессии до конца истории
+        return self.submit(prompt, ModelParams(max_new_tokens=0), session)
+
+    def drop_session(self, session: int) -> None:
+        self.__session_cache.remove(session)
+
+    def register_prefix(self, text: str) -> None:
+        # последний токен префикса может склеиться с продолжением шаблона, поэтому он не кэшируется
+        token_ids: List[int] = self.__tokenizer.encode(text)[:-1]
+        if token_ids:
+            self.__prefix_cache.register(token_ids)
+            logging.info("Зарегистрирован префикс из %s токенов", len(token_ids))
+
+    def __collect_eos_token_ids(self) -> set:
+        eos_token_ids = {self.__tokenizer.eos_token_id}
+        generation_eos = getattr(
+            getattr(self.__model, "generation_config", None), "eos_token_id", None)
+        if isinstance(generation_eos, int):
+            eos_token_ids.add(generation_eos)
+        elif generation_eos:
+            eos_token_ids.update(generation_eos)
+        eos_token_ids.discard(None)
+        return eos_token_ids
+
+    def __loop(self) -> None:
+        while True:
+            try:
+                self.__iteration()
+            except Exception as error:
+                # поток планировщика один на все запросы и не должен завершаться
+                logging.error("Ошибка цикла планировщика: %s", error)
+
+    def __iteration(self) -> None:
+        # новые последовательности присоединяются к батчу на границе токена
+        if not self.active_count:
+            self.__join(self.__pending.get()[2])
+        while self.active_count < self.__max_batch_size:
+            try:
+                self.__join(self.__pending.get_nowait()[2])
+            except Empty:
+                break
+        for request in list(self.__speculative):
+            try:
+                finished: bool = self.__speculative_step(request)
+            except Exception as error:
+                logging.error("Ошибка спекулятивного шага: %s", error)
+                request.put(error)
+                finished = True
+            if finished:
+                self.__speculative.remove(request)
+        if self.__active:
+            try:
+                self.__decode_step()
+            except Exception as error:
+                logging.error("Ошибка шага декодирования: %s", error)
+                for request in self.__active:
+                    request.put(error)
+                self.__active = []
+                self.__past_key_values = None
+                self.__attention_mask = None
+
+    def __forward(self, input_ids: List[int], past_key_values: Optional[tuple]) -> Tuple[torch.Tensor, tuple]:
+        logits, past_key_values = model_forward(
+            self.__model, input_ids, past_key_values)
+        return logits[-1], past_key_values
+
+    def __prefill(self, input_ids: List[int], session: Optional[int]) -> Tuple[torch.Tensor, tuple]:
+        # KV постоянного префикса шаблона считается один раз, дальше предзаполняется только остаток
+        prefix: Tuple[int, ...] = self.__prefix_cache.match(input_ids)
+        length, past_key_values = len(prefix), None
+        if prefix:
+            past_key_values = self.__prefix_cache.get(prefix)
+            if past_key_values is None:
+                past_key_values = self.__forward(list(prefix), None)[1]
+                self.__prefix_cache.put(prefix, past_key_values)
+        # KV сессии чата покрывает всю предыдущую историю; если сессия вытеснена, история пересчитывается
+        if session is not None:
+            session_length, session_past_key_values = self.__session_cache.match(
+                session, input_ids)
+            if session_length > length:
+                length, past_key_values = session_length, session_past_key_values
+        return self.__forward(input_ids[length:], past_key_values)
+
+    def __join(self, request: GenerationRequest) -> None:
+        try:
+            self.__start(request)
+        except Exception as error:
+            # ошибка одного запроса (выборка токена, слияние KV, декодирование) не трогает батч
+            logging.error("Ошибка присоединения запроса к батчу: %s", error)
+            request.put(error)
+
+    @torch.inference_mode()
+    def __start(self, request: GenerationRequest) -> None:
+        # клиент мог уйти, пока запрос ждал в очереди
+        if request.should_stop:
+            self.__stop(request)
+            return
+        start: float = time.perf_counter()
+        request.queue_seconds = start - request.created_at
+        try:
+            logits, past_key_values = self.__prefill(
+                request.input_ids, request.session)
+        except Exception as error:
+            logging.error("Ошибка предзаполнения: %s", error)
+            request.put(error)
+            return
+        request.first_token_at = time.perf_counter()
+        request.prefill_seconds = request.first_token_at - start
+        metrics.observe("diplom_prefill_seconds", request.prefill_seconds)
+        metrics.observe("diplom_queue_seconds", request.queue_seconds)
+        if request.params.max_new_tokens <= 0:
+            self.__session_cache.put(
+                request.session, request.input_ids, past_key_values)
+            request.put(None)
+            return
+        attention_mask = torch.ones(
+            (1, len(request.input_ids)), dtype=torch.long, device=self.__model.device)
+        token: int = sample_token(logits, request.params)
+        if self.__emit(request, token):
+            return
+        if self.__speculative_enabled:
+            # спекулятивные последовательности декодируются по одной с черновой моделью
+            try:
+                request.draft_past = model_forward(
+                    self.__draft_model, request.input_ids, None)[1]
+            except Exception as error:
+                logging.error("Ошибка предзаполнения черновой модели: %s", error)
+                request.put(error)
+                return
+            request.ids = request.input_ids + [token]
+            request.target_past = past_key_values
+            self.__speculative.append(request)
+            return
+        if self.__past_key_values is None:
+            self.__past_key_values, self.__attention_mask = past_key_values, attention_mask
+        else:
+            self.__past_key_values, self.__attention_mask = merge_caches(
+                self.__past_key_values, self.__attention_mask, past_key_values, attention_mask)
+        self.__active.append(request)
+
+    @torch.inference_mode()
+    def __speculative_step(self, request: GenerationRequest) -> bool:
+        start: float = time.perf_counter()
+        params: ModelParams = request.params
+        gamma: int = min(self.__speculative_tokens,
+                         params.max_new_tokens - len(request.tokens))
+        # черновая модель предлагает gamma токенов
+        draft_input: List[int] = request.ids[cache_length(request.draft_past):]
+        proposals: List[int] = []
+        draft_probabilities: List[torch.Tensor] = []
+        for _ in range(gamma):
+            logits, request.draft_past = model_forward(
+                self.__draft_model, draft_input, request.draft_past)
+            probabilities = warp_probabilities(
+                logits[-1, :self.__vocab_size], params)
+            proposals.append(int(torch.multinomial(probabilities, 1)))
+            draft_probabilities.append(probabilities)
+            draft_input = proposals[-1:]
+        # основная модель проверяет все предложения за один проход
+        target_input: List[int] = request.ids[cache_length(
+            request.target_past):] + proposals
+        logits, target_past = model_forward(
+            self.__model, target_input, request.target_past)
+        offset: int = len(target_input) - len(proposals) - 1
+        accepted: List[int] = []
+        extra: Optional[int] = None
+        for position, token in enumerate(proposals):
+            target_probabilities = warp_probabilities(
+                logits[offset + position, :self.__vocab_size], params)
+            # принятие с вероятностью min(1, p/q) сохраняет распределение основной модели
+            if torch.rand(1).item() * draft_probabilities[position][token] < target_probabilities[token]:
+                accepted.append(token)
+                continue
+            residual = (target_probabilities -
+                        draft_probabilities[position]).clamp(min=0)
+            extra = int(torch.multinomial(residual / residual.sum(), 1)) if residual.sum() > 0 \
+                else int(target_probabilities.argmax())
+            break
+        if extra is None:
+            extra = int(torch.multinomial(warp_probabilities(
+                logits[offset + len(proposals), :self.__vocab_size], params), 1))
+        length: int = len(request.ids) + len(accepted)
+        request.target_past = crop_cache(target_past, length)
+        request.draft_past = crop_cache(request.draft_past, min(
+            cache_length(request.draft_past), length))
+        self.__speculative_stats.steps += 1
+        self.__speculative_stats.proposed += len(proposals)
+        self.__speculative_stats.accepted += len(accepted)
+        finished: bool = False
+        for token in accepted + [extra]:
+            request.ids.append(token)
+            self.__speculative_stats.emitted += 1
+            if self.__emit(request, token):
+                finished = True
+                break
+        self.__speculative_stats.seconds += time.perf_counter() - start
+        return finished
+
+    @torch.inference_mode()
+    def __decode_step(self) -> None:
+        start: float = time.perf_counter()
+        input_ids = torch.tensor([[request.tokens[-1]] for request in self.__active],
+                                 device=self.__model.device)
+        attention_mask = F.pad(self.__attention_mask, (0, 1), value=1)
+        position_ids = attention_mask.long().cumsum(-1)[:, -1:] - 1
+        outputs = self.__model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=to_model_cache(self.__past_key_values),
+            use_cache=True
+        )
+        self.__past_key_values = to_legacy_cache(outputs.past_key_values)
+        self.__attention_mask = attention_mask
+        keep: List[int] = []
+        for row, request in enumerate(self.__active):
+            try:
+                if not self.__emit(request, sample_token(outputs.logits[row, -1], request.params)):
+                    keep.append(row)
+            except Exception as error:
+                # строка с ошибкой (например, NaN в вероятностях) уходит из батча, остальные продолжают
+                logging.error("Ошибка выборки токена: %s", error)
+                request.put(error)
+        self.__speculative_stats.decode_tokens += len(self.__active)
+        self.__speculative_stats.decode_seconds += time.perf_counter() - start
+        metrics.observe("diplom_decode_step_seconds",
+                        time.perf_counter() - start)
+        # завершённые последовательности покидают батч на границе токена
+        if len(keep) == len(self.__active):
+            return
+        self.__active = [self.__active[row] for row in keep]
+        if keep:
+            self.__past_key_values, self.__attention_mask = select_cache_rows(
+                self.__past_key_values, self.__attention_mask, keep)
+        else:
+            self.__past_key_values, self.__attention_mask = None, None
+
+    def __stop(self, request: GenerationRequest) -> None:
+        request.cancelled = True
+        self.__cancelled_count += 1
+        metrics.inc("diplom_cancelled_total")
+        logging.info(
+            "Генерация остановлена после %s токенов: клиент отключился или истёк таймаут", len(request.tokens))
+        request.put(None)
+
+    def __emit(self, request: GenerationRequest, token: int) -> bool:
+        # отмена проверяется на каждом токене, строка батча освобождается на этом же шаге
+        if request.should_stop:
+            self.__stop(request)
+            return True
+        finished: bool = token in self.__eos_token_ids
+        if not finished:
+            request.tokens.append(token)
+        finished = finished or len(
+            request.tokens) >= request.params.max_new_tokens
+        text: str = self.__tokenizer.decode(
+            request.tokens, skip_special_tokens=True)
+        if finished or not text.endswith("\ufffd"):
+            if len(text) > request.printed:
+                request.put(text[request.printed:])
+            request.printed = len(text)
+        if finished:
+            request.decode_seconds = time.perf_counter() - request.first_token_at
+            metrics.inc("diplom_generated_tokens_total", len(request.tokens))
+            request.put(None)
+        return finished
+
+
+class TextGenerationModel:
+    def __init__(self, device_params: Optional[DeviceParams] = None, model_path: str = './model',
+                 tokenizer_path: str = './tokenizer', database_path: str = './database',
+                 chats_path: str = chats_path, chats_backend: str = chats_backend, chats_handler=None,
+                 retrievers_read_only: bool = False, preload_retrievers: Optional[List[str]] = None) -> None:
+        self.__device_params: DeviceParams = device_params or DeviceParams.from_env()
+        self.__model_path: str = model_path
+        self.__tokenizer_path: str = tokenizer_path
+        configure_threads(self.__device_params)
         self.__model_params: ModelParams = ModelParams()
+        self.__answer_cache_params: AnswerCacheParams = AnswerCacheParams()
+        self.__answer_cache: AnswerCache = AnswerCache(
+            self.__answer_cache_params.threshold)
+        self.__session_params: SessionParams = SessionParams()
+        self.__speculative_params: SpeculativeParams = SpeculativeParams()
+        self.__cancellation_params: CancellationParams = CancellationParams()
+        self.startup_timings: Dict[str, float] = {}
+        # независимые части загружаются одновременно: веса модели, эмбеддинги и индекс чатов
+        with ThreadPoolExecutor(max_workers=3, thread_name_prefix="startup") as pool:
+            retriever_future = pool.submit(self.__timed, "retrievers", lambda: RetrieverHandler(
+                database_path, device_params=self.__device_params, read_only=retrievers_read_only))
+            # в многопроцессном режиме чатами владеет фронтовой процесс, сюда передаётся его прокси
+            chats_future = pool.submit(
+                self.__timed, "chats", lambda: chats_handler or ChatHandler(chats_path, chats_backend))
+            scheduler_future = pool.submit(self.__timed, "model", self.__load_model)
+            self.__retriever_handler: RetrieverHandler = retriever_future.result()
+            self.__chats_handler: ChatHandler = chats_future.result()
+            self._scheduler: GenerationScheduler = scheduler_future.result()
+        self.__retriever_handler.add_invalidation_listener(
+            self.__answer_cache.invalidate)
+        if preload_retrievers is None:
+            # DIPLOM_PRELOAD — имена баз через запятую или "*"; пусто — базы открываются при первом запросе
+            preload_retrievers = [name.strip() for name in os.environ.get(
+                "DIPLOM_PRELOAD", "").split(",") if name.strip()]
+        self.__timed("indexes", lambda: self.__retriever_handler.preload(preload_retrievers))
+        self.__prompt_builder: PromptBuilder = PromptBuilder(self.__tokenizer, PromptParams(
+            context_window=getattr(self.__model.config, "max_position_embeddings", 4096)))
+        self.__prompt_stats: deque = deque(maxlen=100)
+        self.__chat_name_params: ModelParams = ModelParams(
+            max_new_tokens=24, temperature=0.15, top_k=10, top_p=0.92)
+        self.__naming_pool: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix="chat-name")
+        # ответы пакета дочитываются параллельно и отдаются по мере готовности
+        self.__batch_pool: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=32, thread_name_prefix="batch")
+        if self.__device_params.warmup:
+            self.__timed("warmup", self.warmup)
+        logging.info("Время запуска по компонентам: %s", self.startup_timings)
+
+    def __timed(self, component: str, load):
+        start: float = time.perf_counter()
+        result = load()
+        self.startup_timings[component] = round(
+            time.perf_counter() - start, 3)
+        metrics.observe("diplom_startup_seconds",
+                        self.startup_timings[component], component=component)
+        return result
 
     @property
     def retrievers_status(self) -> dict:
         return {"data": self.__retriever_handler.get_retrievers_status()}
 
+    @property
+    def retrievers_cache_stats(self) -> dict:
+        return self.__retriever_handler.cache_stats
+
+    @property
+    def embedding_stats(self) -> dict:
+        return self.__retriever_handler.embedding_stats
+
+    @property
+    def retriever_params(self) -> dict:
+        return self.__retriever_handler.params
+
     @property
     def model_params(self) -> dict:
         return {
@@ -40,31 +716,39 @@ class TextGenerationModel:
             "top_p": self.__model_params.top_p,
         }
 
+    @property
+    def conversation_status(self) -> dict:
+        return {"enabled": self.__session_params.enabled, **self._scheduler.session_status}
+
+    @property
+    def scheduler_stats(self) -> dict:
+        return {"active": self._scheduler.active_count, "pending": self._scheduler.pending_count}
+
+    def add_retriever_listener(self, listener) -> None:
+        self.__retriever_handler.add_invalidation_listener(listener)
+
+    def refresh_retriever(self, name: Optional[str] = None) -> None:
+        self.__retriever_handler.refresh(name)
+
     @property
     def chat_handler(self) -> ChatHandler:
         return self.__chats_handler
 
+    def drop_session(self, id: int) -> None:
+        self._scheduler.drop_session(id)
+
+    def remove_chat(self, id: int) -> bool:
+        # вместе с чатом освобождается KV его сессии, не дожидаясь вытеснения
+        removed: bool = self.__chats_handler.remove_chat(id)
+        if removed:
+            self.drop_session(id)
+        return removed
+
     def activate_retriever(self, name: str) -> bool:
-        try:
-            self.__retriever_handler[name].status = True
-            logging.info(f"Активация базы знаний {name}")
-            return True
-        except:
-            pass
-        else:
-            logging.error(f"Активация базы знаний {name} не удалась")
-            return False
+        return self.__retriever_handler.activate_retriever(name)
 
     def deactivate_retriever(self, name: str) -> bool:
-        try:
-            self.__retriever_handler[name].status = False
-            logging.info(f"Деактивация базы знаний {name}")
-            return True
-        except:
-            pass
-        else:
-            logging.error(f"Дективация базы знаний {name} не удалась")
-            return False
+        return self.__retriever_handler.deactivate_retriever(name)
 
     def change_retriever_name(self, old_name: str, new_name: str) -> bool:
         return self.__retriever_handler.change_retriever_name(old_name, new_name)
@@ -75,104 +759,312 @@ class TextGenerationModel:
     def add_text_in_retriever(self, name: str, text: str) -> bool:
         return self.__retriever_handler.add_text_in_retriever(name, text)
 
-    def add_document_in_retriever(self, name: str, url: str) -> bool:
-        return self.__retriever_handler.add_document_in_retriever(name, url)
+    def add_document_in_retriever(self, name: str, url: str) -> Optional[str]:
+        return self.__retriever_handler.submit_document_in_retriever(name, url)
 
-    def create_retriever_from_document(self, name: str, url: str) -> bool:
-        return self.__retriever_handler.create_retriever_from_document(name, url)
+    def create_retriever_from_document(self, name: str, url: str, index_params: Optional[IndexParams] = None) -> Optional[str]:
+        return self.__retriever_handler.submit_retriever_from_document(name, url, index_params)
+
+    def ingestion_status(self, job_id: str) -> Optional[dict]:
+        return self.__retriever_handler.ingestion_status(job_id)
+
+    @property
+    def ingestion_jobs(self) -> dict:
+        return {"data": self.__retriever_handler.ingestion_jobs()}
+
+    def rebuild_retriever(self, name: str, index_params: IndexParams) -> Optional[str]:
+        return self.__retriever_handler.submit_rebuild_retriever(name, index_params)
 
     def set_model_params(self, max_new_tokens: int = 0, temperature: float = 0, top_k: int = 0, top_p: int = 0) -> None:
         if max_new_tokens != 0:
             logging.info(
-                f"Изменение параметра max_new_tokens {self.__model_params.max_new_tokens} -> {max_new_tokens}")
+                "Изменение параметра max_new_tokens %s -> %s", self.__model_params.max_new_tokens, max_new_tokens)
             self.__model_params.max_new_tokens = max_new_tokens
         if temperature != 0:
             logging.info(
-                f"Изменение параметра temperature {self.__model_params.temperature} -> {temperature}")
+                "Изменение параметра temperature %s -> %s", self.__model_params.temperature, temperature)
             self.__model_params.temperature = temperature
         if top_k != 0:
             logging.info(
-                f"Изменение параметра top_k {self.__model_params.top_k} -> {top_k}")
+                "Изменение параметра top_k %s -> %s", self.__model_params.top_k, top_k)
             self.__model_params.top_k = top_k
         if top_p != 0:
             logging.info(
-                f"Изменение параметра top_p {self.__model_params.top_p} -> {top_p}")
+                "Изменение параметра top_p %s -> %s", self.__model_params.top_p, top_p)
             self.__model_params.top_p = top_p
 
+    def set_retriever_params(self, k: int = 0, score_threshold: float = -1) -> None:
+        self.__retriever_handler.set_params(k, score_threshold)
+
+    @property
+    def prompt_params(self) -> dict:
+        return self.__prompt_builder.params.dict()
+
+    @property
+    def prompt_stats(self) -> dict:
+        return {"data": list(self.__prompt_stats)}
+
+    def set_prompt_params(self, max_context_tokens: int = 0, duplicate_threshold: float = 0) -> None:
+        params: PromptParams = self.__prompt_builder.params
+        if max_context_tokens > 0:
+            logging.info(
+                "Изменение параметра max_context_tokens %s -> %s", params.max_context_tokens, max_context_tokens)
+            params.max_context_tokens = max_context_tokens
+        if 0 < duplicate_threshold <= 1:
+            logging.info(
+                "Изменение параметра duplicate_threshold %s -> %s", params.duplicate_threshold, duplicate_threshold)
+            params.duplicate_threshold = duplicate_threshold
+
+    @property
+    def cancellation_params(self) -> dict:
+        return {**self.__cancellation_params.dict(), "cancelled": self._scheduler.cancelled_count}
+
+    def set_cancellation_params(self, save_partial: bool = False, timeout: float = 0) -> None:
+        logging.info(
+            "Изменение сохранения неполных ответов %s -> %s", self.__cancellation_params.save_partial, save_partial)
+        self.__cancellation_params.save_partial = save_partial
+        if timeout > 0:
+            logging.info(
+                "Изменение таймаута генерации %s -> %s", self.__cancellation_params.timeout, timeout)
+            self.__cancellation_params.timeout = timeout
+
+    @property
+    def answer_cache_stats(self) -> dict:
+        return {"enabled": self.__answer_cache_params.enabled, **self.__answer_cache.stats}
+
+    def set_answer_cache_params(self, enabled: bool = True, threshold: float = -1) -> None:
+        logging.info(
+            "Изменение кэша ответов %s -> %s", self.__answer_cache_params.enabled, enabled)
+        self.__answer_cache_params.enabled = enabled
+        if 0 < threshold <= 1:
+            logging.info(
+                "Изменение порога кэша ответов %s -> %s", self.__answer_cache_params.threshold, threshold)
+            self.__answer_cache_params.threshold = threshold
+            self.__answer_cache.threshold = threshold
+        if not enabled:
+            self.__answer_cache.invalidate()
+
+    @property
+    def speculative_stats(self) -> dict:
+        return self._scheduler.speculative_stats
+
+    def set_speculative_mode(self, enabled: bool) -> bool:
+        logging.info("Изменение спекулятивного режима -> %s", enabled)
+        if self._scheduler.set_speculative(enabled):
+            self.__speculative_params.enabled = enabled
+            return True
+        logging.error("Черновая модель не загружена")
+        return False
+
+    def set_conversation_mode(self, enabled: bool) -> None:
+        logging.info(
+            "Изменение режима диалога %s -> %s", self.__session_params.enabled, enabled)
+        self.__session_params.enabled = enabled
+
     def __load_model(self):
         logging.info("Загрузка модели")
-        self.__model = AutoModelForCausalLM.from_pretrained(
-            './model',
-            torch_dtype=torch.bfloat16
-        )
-        logging.info(f"Загрузка токенизатора")
-        self.__tokenizer = AutoTokenizer.from_pretrained('./tokenizer')
-        logging.info(f"Создание стримера")
-        streamer = TextStreamer(
-            self.__tokenizer,
-            skip_prompt=True,
-            skip_special_tokens=True
-        )
-        logging.info(f"Создание конвейера")
-        return pipeline(
-            'text-generation',
-            model=self.__model,
-            tokenizer=self.__tokenizer,
-            device='cuda:0',
-            streamer=streamer
-        )
+        self.__model = load_model(self.__model_path, self.__device_params)
+        logging.info("Загрузка токенизатора")
+        self.__tokenizer = AutoTokenizer.from_pretrained(self.__tokenizer_path)
+        draft_model = None
+        if os.path.isdir(self.__speculative_params.draft_path):
+            logging.info("Загрузка черновой модели")
+            draft_model = load_model(
+                self.__speculative_params.draft_path, self.__device_params)
+        logging.info("Создание планировщика генерации")
+        scheduler = GenerationScheduler(
+            self.__model, self.__tokenizer, session_params=self.__session_params,
+            draft_model=draft_model, speculative_tokens=self.__speculative_params.num_tokens)
+        scheduler.set_speculative(self.__speculative_params.enabled)
+        scheduler.register_prefix(template_prefix(user_template))
+        scheduler.register_prefix(template_prefix(chat_template))
+        return scheduler
+
+    def warmup(self) -> None:
+        # первый проход инициализирует ядра и кэши префиксов до прихода пользователей
+        logging.info("Прогрев модели на %s", self.__device_params.device)
+        self.__retriever_handler.warmup()
+        "".join(self._scheduler.submit(user_template.format(
+            context="", question="warmup", chat_name="warmup"), ModelParams(max_new_tokens=4)))
+        "".join(self._scheduler.submit(chat_template.format(
+            question="warmup"), ModelParams(max_new_tokens=4)))
 
     def __generate_chat_name(self, user_prompt: str) -> str:
         prompt: str = chat_template.format(question=user_prompt)
-        generator = self._model_pipeline(
-            prompt,
-            max_new_tokens=24,
-            do_sample=True,
-            temperature=0.15,
-            top_k=10,
-            top_p=0.92,
-            num_return_sequences=1,
-            return_full_text=False,
-        )
-        chat_name: str = ""
-        for output in generator:
-            chat_name += f"{output['generated_text']} "
+        chat_name: str = "".join(
+            self._scheduler.submit(prompt, self.__chat_name_params, priority=PRIORITY_CHAT_NAME)) + " "
         if "Chat Name " in chat_name:
             chat_name[chat_name.index("Chat Name"):]
         return chat_name.strip('\n')[:-1]
 
-    def __call__(self, question: str, id: int = -1):
+    @staticmethod
+    def __extract_chat_name(question: str, words: int = 6) -> str:
+        chat_name: str = " ".join(re.findall(r"\w+", question)[:words])
+        return chat_name[:48] or "New chat"
+
+    def __name_chat(self, id: int, question: str) -> None:
+        # при занятом GPU остаётся извлечённое из вопроса имя
+        if self._scheduler.busy:
+            logging.info("Модель занята, для чата %s оставлено извлечённое имя", id)
+            return
+        trace = Trace("chat_name")
+        try:
+            with trace.span("generation"):
+                chat_name: str = self.__generate_chat_name(question).strip()
+            if chat_name:
+                with trace.span("chat_save"):
+                    self.__chats_handler(id).chat_name = chat_name
+                logging.info("Чат %s переименован в %s", id, chat_name)
+            trace.finish(id=id)
+        except Exception as error:
+            logging.error("Генерация имени чата %s не удалась: %s", id, error)
+
+    def __conversation_prompt(self, chat_name: str, history: List[Dict], question: str,
+                              max_new_tokens: int) -> Tuple[str, int]:
+        return self.__prompt_builder.fit_history(
+            conversation_template.format(chat_name=chat_name),
+            [conversation_turn_template.format(question=pair["user"], answer=pair["bot"]) for pair in history],
+            conversation_question_template.format(context="", question=question) if question else "",
+            max_new_tokens)
+
+    def answer_batch(self, questions: List[Tuple[str, str]], batch_size: int = 32) -> Iterator[dict]:
+        # пакетный режим не создаёт чатов и не трогает кэш ответов
+        model_params: ModelParams = ModelParams(**self.model_params)
+        for start in range(0, len(questions), batch_size):
+            window: List[Tuple[str, str]] = questions[start:start + batch_size]
+            found: list = self.__retriever_handler.search_batch(
+                [question for _, question in window])
+            prompts: list = []
+            for (question_id, question), documents in zip(window, found):
+                prompt, stats = self.__prompt_builder.build(
+                    lambda context: user_template.format(
+                        context=context, question=question, chat_name=""),
+                    documents, model_params.max_new_tokens)
+                prompts.append((stats["prompt_tokens"], question_id, question, prompt))
+            # близкие по длине промпты попадают в батч вместе и меньше дополняются
+            prompts.sort(key=lambda item: item[0])
+            requests: list = [(question_id, question, tokens, self._scheduler.submit(
+                prompt, model_params, priority=PRIORITY_BATCH)) for tokens, question_id, question, prompt in prompts]
+            # длинная генерация не задерживает уже готовые ответы: порядок не важен, id есть в каждом
+            futures: dict = {self.__batch_pool.submit("".join, request): (question_id, question, tokens)
+                             for question_id, question, tokens, request in requests}
+            try:
+                for future in as_completed(futures):
+                    question_id, question, tokens = futures[future]
+                    try:
+                        answer: str = future.result()
+                    except Exception as error:
+                        logging.error(
+                            "Пакетный ответ на %s не получен: %s", question_id, error)
+                        yield {"id": question_id, "question": question, "error": str(error)}
+                        continue
+                    yield {"id": question_id, "question": question, "answer": answer,
+                           "prompt_tokens": tokens}
+            finally:
+                # если потребитель ушёл, оставшиеся запросы окна освобождают батч
+                for _, _, _, request in requests:
+                    request.cancel()
+
+    def __call__(self, question: str, id: int = -1, cancel_event: Optional[Event] = None,
+                 timeout: Optional[float] = None, priority: int = PRIORITY_INTERACTIVE):
         logging.info("Генерация текста")
+        trace = Trace("chat")
         chat_name: str = ""
         if id == -1:
-            logging.info(f"Генерация имени нового чата")
-            chat_name = self.__generate_chat_name(question)
-            id = self.__chats_handler.create_chat(chat_name)
+            # ответ начинается сразу под временным именем, настоящее генерируется в фоне
+            chat_name = self.__extract_chat_name(question)
+            with trace.span("chat_save"):
+                id = self.__chats_handler.create_chat(chat_name)
+            logging.info("Генерация имени нового чата %s", id)
+            self.__naming_pool.submit(self.__name_chat, id, question)
         else:
-            chat_name = self.__chats_handler(id)
-        docs: str = self.__retriever_handler(question)
-        prompt: str = user_template.format(
-            context=docs, question=question, chat_name=chat_name)
-
-        # генерация
-        generator = self._model_pipeline(
-            prompt,
-            max_new_tokens=self.__model_params.max_new_tokens,
-            do_sample=True,
-            temperature=self.__model_params.temperature,
-            top_k=self.__model_params.top_k,
-            top_p=self.__model_params.top_p,
-            num_return_sequences=1,
-            return_full_text=False,
-        )
+            with trace.span("chat_load"):
+                chat_name = self.__chats_handler(id).chat_name
+        conversation: bool = self.__session_params.enabled
+        # в режиме диалога ответ зависит от истории, поэтому кэш ответов не используется
+        cached: bool = self.__answer_cache_params.enabled and not conversation
+        if cached:
+            names: frozenset = self.__retriever_handler.active_names
+            version: int = self.__answer_cache.version
+            with trace.span("embedding"):
+                embedding: List[float] = self.__retriever_handler.embed_query(
+                    question)
+            with trace.span("answer_cache"):
+                answer: Optional[str] = self.__answer_cache.get(
+                    embedding, names)
+            if answer is not None:
+                yield answer
+                with trace.span("chat_save"):
+                    self.__chats_handler(id).add_pair(
+                        Pair(
+                            user=question,
+                            bot=answer
+                        )
+                    )
+                trace.finish(id=id, cache_hit=True)
+                return
+        with trace.span("retrieval"):
+            documents: list = self.__retriever_handler.search(
+                question, embedding if cached else None)
+        model_params: ModelParams = ModelParams(**self.model_params)
+        if conversation:
+            history_prompt, dropped_turns = self.__conversation_prompt(
+                chat_name, self.__chats_handler(id).chat_history, question, model_params.max_new_tokens)
+
+            def render(context: str) -> str:
+                return history_prompt + conversation_question_template.format(context=context, question=question)
+        else:
+            def render(context: str) -> str:
+                return user_template.format(context=context, question=question, chat_name=chat_name)
+        with trace.span("prompt_build"):
+            prompt, stats = self.__prompt_builder.build(
+                render, documents, model_params.max_new_tokens)
+        if conversation:
+            stats["dropped_turns"] = dropped_turns
+        self.__prompt_stats.append({"id": id, **stats})
+
+        # генерация в общем цикле декодирования, токены приходят по мере декодирования
+        generation = self._scheduler.submit(
+            prompt, model_params, session=id if conversation else None,
+            priority=priority, cancel_event=cancel_event,
+            timeout=min(timeout or self.__cancellation_params.timeout, self.__cancellation_params.timeout))
         generated_text: str = ""
-        for output in generator:
-            generated_text += f"{output['generated_text']} "
-            yield output['generated_text']
-
-        self.__chats_handler(id).add_pair(
-            Pair(
-                user=question,
-                bot=generated_text
+        try:
+            for new_text in generation:
+                generated_text += new_text
+                yield new_text
+        except GeneratorExit:
+            # потребитель закрыл поток — декодирование останавливается на следующем токене
+            generation.cancel()
+            generation.cancelled = True
+        trace.add("queue", generation.queue_seconds)
+        trace.add("prefill", generation.prefill_seconds)
+        trace.add("decode", generation.decode_seconds)
+        if generation.cancelled:
+            if self.__cancellation_params.save_partial and generated_text:
+                with trace.span("chat_save"):
+                    self.__chats_handler(id).add_pair(
+                        Pair(
+                            user=question,
+                            bot=generated_text
+                        )
+                    )
+            trace.finish(id=id, tokens=len(generation.tokens), cancelled=True)
+            return
+
+        if cached:
+            self.__answer_cache.put(embedding, names, generated_text, version)
+        with trace.span("chat_save"):
+            self.__chats_handler(id).add_pair(
+                Pair(
+                    user=question,
+                    bot=generated_text
+                )
             )
-        )
+        trace.finish(id=id, tokens=len(generation.tokens),
+                     prompt_tokens=stats["prompt_tokens"])
+        if conversation:
+            # KV истории вместе с новым ответом дозаполняется вне критического пути
+            self._scheduler.store_session(
+                id, self.__conversation_prompt(chat_name, self.__chats_handler(id).chat_history, "",
+                                               model_params.max_new_tokens)[0])
@@ -1,12 +1,23 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
 from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 from pydantic import BaseModel
-from model import TextGenerationModel
+from threading import Event, Thread
+from typing import List, Optional
+from model import TextGenerationModel, PRIORITY_INTERACTIVE, PRIORITY_BATCH
+from batch_qa import parse_questions, run_batch
+from AdmissionController import AdmissionController, AdmissionParams, QueueFull, DeadlineExceeded
+from index_factory import IndexParams
+from workers import WorkerPool
+from log_config import configure_logging
+from metrics import metrics
+import json
+import os
+import time
 import logging
-logging.basicConfig(level=logging.INFO, filename="py_log.log", filemode="a",
-                    format="%(asctime)s %(levelname)s %(message)s")
+configure_logging()
 logging.info("Запуск сервера")
 app = FastAPI()
 
@@ -18,19 +29,126 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-logging.info("Создание генеративной модели")
-txt_model = TextGenerationModel()
+# модель создаётся при старте приложения; до старта её можно подменить, например в бенчмарке
+txt_model: Optional[TextGenerationModel] = None
+admission = AdmissionController(AdmissionParams())
+
+
+startup_error: Optional[str] = None
+PROBE_PATHS = ("/healthz", "/readyz", "/metrics")
+
+
+def create_model() -> None:
+    global txt_model, startup_error
+    logging.info("Создание генеративной модели")
+    try:
+        # DIPLOM_WORKERS > 0: модель живёт в отдельных процессах, здесь остаются HTTP и чаты
+        workers: int = int(os.environ.get("DIPLOM_WORKERS", "0"))
+        model = WorkerPool(workers) if workers > 0 else TextGenerationModel()
+    except Exception as error:
+        logging.error("Создание генеративной модели не удалось: %s", error)
+        startup_error = str(error)
+        return
+    txt_model = model
+    metrics.add_collector(collect_metrics)
+
+
+@app.on_event("startup")
+async def start_model():
+    # порт открывается сразу, модель и индексы загружаются в фоне
+    if txt_model is None:
+        Thread(target=create_model, name="startup", daemon=True).start()
+    else:
+        metrics.add_collector(collect_metrics)
+
+
+@app.middleware("http")
+async def require_model(request: Request, call_next):
+    if txt_model is None and request.url.path not in PROBE_PATHS:
+        return JSONResponse(jsonable_encoder({"error": "model is not ready"}), status_code=503,
+                            headers={"Retry-After": "5"})
+    return await call_next(request)
+
+
+@app.get("/healthz")
+async def healthz():
+    return JSONResponse(jsonable_encoder({"status": "alive"}))
+
+
+@app.get("/readyz")
+async def readyz():
+    if txt_model is not None:
+        return JSONResponse(jsonable_encoder({"status": "ready", "startup": txt_model.startup_timings}))
+    if startup_error is not None:
+        return JSONResponse(jsonable_encoder({"status": "failed", "error": startup_error}), status_code=503)
+    return JSONResponse(jsonable_encoder({"status": "starting"}), status_code=503)
+
+
+def collect_metrics() -> dict:
+    collected: dict = {
+        "diplom_admission_{name}".format(name=name): value for name, value in admission.stats.items()}
+    collected.update({"diplom_scheduler_{name}".format(name=name): value
+                      for name, value in txt_model.scheduler_stats.items()})
+    collected.update({"diplom_answer_cache_{name}".format(name=name): value
+                      for name, value in txt_model.answer_cache_stats.items() if isinstance(value, (int, float))})
+    collected.update({"diplom_embedding_{name}".format(name=name): value
+                      for name, value in txt_model.embedding_stats.items()})
+    collected.update({"diplom_query_cache_{name}".format(name=name): value
+                      for name, value in txt_model.retrievers_cache_stats.items() if isinstance(value, (int, float))})
+    return collected
 
 
 class ChatRequest(BaseModel):
     text: str
     id: int = -1
+    offset: int = 0
+    limit: int = 0
+    deadline: float = 0
 
 
 class TextRequest(BaseModel):
     text: str
 
 
+class RetrieverParams(BaseModel):
+    k: int = 0
+    score_threshold: float = -1
+
+
+class PromptParamsRequest(BaseModel):
+    max_context_tokens: int = 0
+    duplicate_threshold: float = 0
+
+
+class BatchRequest(BaseModel):
+    # вопросы приходят в теле запроса: пути на сервере клиенту не доступны
+    questions: str
+    skip_ids: List[str] = []
+    id_field: str = "id"
+    text_field: str = "question"
+    batch_size: int = 32
+
+
+class AdmissionRequest(BaseModel):
+    max_concurrent: int = 0
+    max_queue: int = 0
+    deadline: float = 0
+
+
+class CancellationRequest(BaseModel):
+    save_partial: bool = False
+    timeout: float = 0
+
+
+class AnswerCacheRequest(BaseModel):
+    enabled: bool = True
+    threshold: float = -1
+
+
+class ConversationModeRequest(BaseModel):
+    enabled: bool
+
+
 class ModelParams(BaseModel):
     max_new_tokens: int = 0
     temperature: float = 0
@@ -39,7 +157,7 @@ class ModelParams(BaseModel):
 
 
 @app.post('/set_model_params/')
-async def set_model_params(model_params_request: ModelParams):
+def set_model_params(model_params_request: ModelParams):
     txt_model.set_model_params(model_params_request.max_new_tokens,
                                model_params_request.temperature,
                                model_params_request.top_k,
@@ -49,17 +167,117 @@ async def set_model_params(model_params_request: ModelParams):
 
 
 @app.get('/get_model_params/')
-async def get_model_params():
+def get_model_params():
     return JSONResponse(jsonable_encoder(txt_model.model_params))
 
 
+@app.post('/set_retriever_params/')
+def set_retriever_params(retriever_params_request: RetrieverParams):
+    txt_model.set_retriever_params(retriever_params_request.k,
+                                   retriever_params_request.score_threshold)
+    return JSONResponse(jsonable_encoder({"params_set": True}))
+
+
+@app.get('/get_retriever_params/')
+def get_retriever_params():
+    return JSONResponse(jsonable_encoder(txt_model.retriever_params))
+
+
+@app.post('/set_prompt_params/')
+def set_prompt_params(prompt_params_request: PromptParamsRequest):
+    txt_model.set_prompt_params(
+        prompt_params_request.max_context_tokens, prompt_params_request.duplicate_threshold)
+    return JSONResponse(jsonable_encoder(txt_model.prompt_params))
+
+
+@app.get('/get_prompt_stats/')
+def get_prompt_stats():
+    return JSONResponse(jsonable_encoder(txt_model.prompt_stats))
+
+
+@app.post('/set_admission_params/')
+async def set_admission_params(admission_request: AdmissionRequest):
+    if admission_request.max_concurrent > 0:
+        admission.params.max_concurrent = admission_request.max_concurrent
+        admission.dispatch()
+    if admission_request.max_queue > 0:
+        admission.params.max_queue = admission_request.max_queue
+    if admission_request.deadline > 0:
+        admission.params.deadline = admission_request.deadline
+    logging.info("Изменение параметров допуска %s", admission.params)
+    return JSONResponse(jsonable_encoder(admission.params))
+
+
+@app.get('/get_admission_stats/')
+async def get_admission_stats():
+    return JSONResponse(jsonable_encoder(admission.stats))
+
+
+@app.post('/set_cancellation_params/')
+def set_cancellation_params(cancellation_request: CancellationRequest):
+    txt_model.set_cancellation_params(
+        cancellation_request.save_partial, cancellation_request.timeout)
+    return JSONResponse(jsonable_encoder(txt_model.cancellation_params))
+
+
+@app.get('/get_cancellation_params/')
+def get_cancellation_params():
+    return JSONResponse(jsonable_encoder(txt_model.cancellation_params))
+
+
+@app.post('/set_answer_cache_params/')
+def set_answer_cache_params(answer_cache_request: AnswerCacheRequest):
+    txt_model.set_answer_cache_params(
+        answer_cache_request.enabled, answer_cache_request.threshold)
+    return JSONResponse(jsonable_encoder(txt_model.answer_cache_stats))
+
+
+@app.get('/get_answer_cache_stats/')
+def get_answer_cache_stats():
+    return JSONResponse(jsonable_encoder(txt_model.answer_cache_stats))
+
+
+@app.post('/set_speculative_mode/')
+def set_speculative_mode(speculative_mode_request: ConversationModeRequest):
+    if txt_model.set_speculative_mode(speculative_mode_request.enabled):
+        return JSONResponse(jsonable_encoder({"speculative_mode": speculative_mode_request.enabled}))
+    else:
+        return JSONResponse(jsonable_encoder({"error": "draft model is not loaded"}))
+
+
+@app.get('/get_speculative_stats/')
+def get_speculative_stats():
+    return JSONResponse(jsonable_encoder(txt_model.speculative_stats))
+
+
+@app.post('/set_conversation_mode/')
+def set_conversation_mode(conversation_mode_request: ConversationModeRequest):
+    txt_model.set_conversation_mode(conversation_mode_request.enabled)
+    return JSONResponse(jsonable_encoder({"conversation_mode": conversation_mode_request.enabled}))
+
+
+@app.get('/get_conversation_status/')
+def get_conversation_status():
+    return JSONResponse(jsonable_encoder(txt_model.conversation_status))
+
+
 @app.get('/get_retrievers_status/')
-async def get_retrievers_status():
+def get_retrievers_status():
     return JSONResponse(jsonable_encoder(txt_model.retrievers_status))
 
 
+@app.get('/get_embedding_stats/')
+def get_embedding_stats():
+    return JSONResponse(jsonable_encoder(txt_model.embedding_stats))
+
+
+@app.get('/get_retrievers_cache_stats/')
+def get_retrievers_cache_stats():
+    return JSONResponse(jsonable_encoder(txt_model.retrievers_cache_stats))
+
+
 @app.post('/activate_retriever/')
-async def activate_retriever(name: TextRequest):
+def activate_retriever(name: TextRequest):
     if txt_model.activate_retriever(name.text):
         return JSONResponse(jsonable_encoder({"{name}".format(name=name.text): "activated"}))
     else:
@@ -67,7 +285,7 @@ async def activate_retriever(name: TextRequest):
 
 
 @app.post('/deactivate_retriever/')
-async def deactivate_retriever(name: TextRequest):
+def deactivate_retriever(name: TextRequest):
     if txt_model.deactivate_retriever(name.text):
         return JSONResponse(jsonable_encoder({"{name}".format(name=name.text): "deactivated"}))
     else:
@@ -75,7 +293,7 @@ async def deactivate_retriever(name: TextRequest):
 
 
 @app.post('/change_retriever_name/')
-async def change_retriever_name(old_name: TextRequest, new_name: TextRequest):
+def change_retriever_name(old_name: TextRequest, new_name: TextRequest):
     if txt_model.change_retriever_name(old_name.text, new_name.text):
         return JSONResponse(jsonable_encoder({"info": "retriever {old_name} has been renamed -> {new_name}".format(old_name=old_name.text, new_name=new_name.text)}))
     else:
@@ -83,7 +301,7 @@ async def change_retriever_name(old_name: TextRequest, new_name: TextRequest):
 
 
 @app.post('/remove_retriever/')
-async def remove_retriever(name: TextRequest):
+def remove_retriever(name: TextRequest):
     if txt_model.remove_retriever(name.text):
         return JSONResponse(jsonable_encoder({"info": "retriever {name} has been removed".format(name=name.text)}))
     else:
@@ -91,7 +309,7 @@ async def remove_retriever(name: TextRequest):
 
 
 @app.post('/add_text_in_retriever/')
-async def add_text_in_retriever(name: TextRequest, text: TextRequest):
+def add_text_in_retriever(name: TextRequest, text: TextRequest):
     if txt_model.add_text_in_retriever(name.text, text.text):
         return JSONResponse(jsonable_encoder({"info": "text has been added in {name}".format(name=name.text)}))
     else:
@@ -99,43 +317,168 @@ async def add_text_in_retriever(name: TextRequest, text: TextRequest):
 
 
 @app.post('/add_document_in_retriever/')
-async def add_document_in_retriever(name: TextRequest, url: TextRequest):
-    if txt_model.add_document_in_retriever(name.text, url.text):
-        return JSONResponse(jsonable_encoder({"info": "document has been added -> {name}".format(name=name.text)}))
+def add_document_in_retriever(name: TextRequest, url: TextRequest):
+    job_id = txt_model.add_document_in_retriever(name.text, url.text)
+    if job_id:
+        return JSONResponse(jsonable_encoder({"info": "document is being added -> {name}".format(name=name.text), "job_id": job_id}))
     else:
         return JSONResponse(jsonable_encoder({"error": "documnt hasn't been added -> {name}"}))
 
 
 @app.post('/create_retriever_from_document/')
-async def create_retriever_from_document(url: TextRequest, retriever_name: TextRequest):
-    if txt_model.create_retriever_from_document(url.text, retriever_name.text):
-        return JSONResponse(jsonable_encoder({"info": "retriever {name} has been created".format(name=retriever_name.text)}))
+def create_retriever_from_document(url: TextRequest, retriever_name: TextRequest, index_params: IndexParams = IndexParams()):
+    job_id = txt_model.create_retriever_from_document(
+        retriever_name.text, url.text, index_params)
+    if job_id:
+        return JSONResponse(jsonable_encoder({"info": "retriever {name} is being created".format(name=retriever_name.text), "job_id": job_id}))
     else:
         return JSONResponse(jsonable_encoder({"error": "retriever hasnt been created"}))
 
 
+@app.post('/get_ingestion_status/')
+def get_ingestion_status(job: TextRequest):
+    status = txt_model.ingestion_status(job.text)
+    if status:
+        return JSONResponse(jsonable_encoder(status))
+    else:
+        return JSONResponse(jsonable_encoder({"error": "job {job_id} not found".format(job_id=job.text)}), status_code=404)
+
+
+@app.get('/get_ingestion_jobs/')
+def get_ingestion_jobs():
+    return JSONResponse(jsonable_encoder(txt_model.ingestion_jobs))
+
+
+@app.post('/rebuild_retriever/')
+def rebuild_retriever(name: TextRequest, index_params: IndexParams):
+    job_id = txt_model.rebuild_retriever(name.text, index_params)
+    if job_id:
+        return JSONResponse(jsonable_encoder({"info": "retriever {name} is being rebuilt as {index_type}".format(name=name.text, index_type=index_params.index_type), "job_id": job_id}))
+    else:
+        return JSONResponse(jsonable_encoder({"error": "retriever {name} hasnt been rebuilt".format(name=name.text)}))
+
+
 @app.get('/get_chats_names/')
-async def get_chats_names():
+def get_chats_names():
     return JSONResponse(jsonable_encoder(txt_model.chat_handler.chat_names()))
 
 
 @app.post('/get_chat_history/')
-async def get_chat_history(chat: ChatRequest):
-    return JSONResponse(jsonable_encoder(txt_model.chat_handler(chat.id).chat_history))
+def get_chat_history(chat: ChatRequest):
+    return JSONResponse(jsonable_encoder(txt_model.chat_handler.chat_history(chat.id, chat.offset, chat.limit)))
 
 
 @app.post('/remove_chat/')
-async def remove_chat(chat: ChatRequest):
-    if txt_model.chat_handler.remove_chat(chat.id):
+def remove_chat(chat: ChatRequest):
+    if txt_model.remove_chat(chat.id):
         return JSONResponse(jsonable_encoder({"info": "chat {name} has been removed".format(name=chat.id)}))
     else:
         return JSONResponse(jsonable_encoder({"error": "chat hasnt been removed"}))
 
 
+class AdmittedStreamingResponse(StreamingResponse):
+    # тело может так и не начать читаться (клиент ушёл до отправки заголовков),
+    # поэтому место в очереди возвращается и по завершении самого ответа
+    def __init__(self, content, on_close, **kwargs) -> None:
+        super().__init__(content, **kwargs)
+        self.__on_close = on_close
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.__on_close()
+
+
+def admitted_cleanup(generation, cancel_event: Optional[Event] = None):
+    closed: list = []
+
+    async def close() -> None:
+        # вызывается и из тела ответа, и из самого ответа — место освобождается ровно один раз
+        if closed:
+            return
+        closed.append(True)
+        if cancel_event is not None:
+            cancel_event.set()
+        try:
+            # finally генератора может писать чат на диск, это не должно блокировать цикл событий
+            await run_in_threadpool(generation.close)
+        except ValueError:
+            pass
+        finally:
+            admission.release()
+    return close
+
+
 @app.post("/stream/")
-async def stream(chat_request: ChatRequest):
-    async def generate_responses():
-        for generated_text in txt_model(chat_request.text, chat_request.id):
-            yield f"{generated_text}\n"
+async def stream(chat_request: ChatRequest, request: Request):
+    start: float = time.monotonic()
+    deadline: float = chat_request.deadline or admission.params.deadline
+    try:
+        await admission.acquire(PRIORITY_INTERACTIVE, deadline)
+    except (QueueFull, DeadlineExceeded) as error:
+        return JSONResponse(jsonable_encoder({"error": str(error)}), status_code=429,
+                            headers={"Retry-After": str(error.retry_after)})
+    cancel_event: Event = Event()
+    try:
+        # оставшееся после ожидания в очереди время ограничивает генерацию
+        generation = txt_model(chat_request.text, chat_request.id, cancel_event,
+                               timeout=max(deadline - (time.monotonic() - start), 1.0) if chat_request.deadline else None)
+    except BaseException:
+        admission.release()
+        raise
+    close = admitted_cleanup(generation, cancel_event)
 
-    return StreamingResponse(generate_responses(), media_type="text/plain")
+    async def generate_responses():
+        # генератор модели блокирующий, поэтому каждый шаг выполняется в пуле потоков
+        try:
+            async for generated_text in iterate_in_threadpool(generation):
+                if await request.is_disconnected():
+                    logging.info("Клиент отключился, генерация отменяется")
+                    break
+                yield generated_text
+        finally:
+            # при обрыве соединения планировщик освобождает место в батче
+            await close()
+
+    return AdmittedStreamingResponse(generate_responses(), close, media_type="text/plain")
+
+
+@app.post("/batch/")
+async def batch(batch_request: BatchRequest):
+    try:
+        questions = parse_questions(batch_request.questions.splitlines(),
+                                    batch_request.id_field, batch_request.text_field)
+    except (KeyError, ValueError) as error:
+        return JSONResponse(jsonable_encoder({"error": str(error)}), status_code=400)
+    # для продолжения прерванного пакета клиент передаёт id уже полученных ответов
+    skip_ids = set(batch_request.skip_ids)
+    questions = [(question_id, question) for question_id, question in questions
+                 if question_id not in skip_ids]
+    try:
+        await admission.acquire(PRIORITY_BATCH)
+    except (QueueFull, DeadlineExceeded) as error:
+        return JSONResponse(jsonable_encoder({"error": str(error)}), status_code=429,
+                            headers={"Retry-After": str(error.retry_after)})
+    try:
+        results = run_batch(txt_model, questions,
+                            batch_size=batch_request.batch_size)
+    except BaseException:
+        admission.release()
+        raise
+    close = admitted_cleanup(results)
+
+    async def generate_results():
+        try:
+            async for result in iterate_in_threadpool(results):
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        finally:
+            await close()
+
+    return AdmittedStreamingResponse(generate_results(), close, media_type="application/x-ndjson")
+
+
+@app.get("/metrics")
+async def get_metrics():
+    # сборщики опрашивают обработчики модели по каналу, поэтому рендер идёт в пуле потоков
+    return PlainTextResponse(await run_in_threadpool(metrics.render))
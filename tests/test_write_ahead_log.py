@@ -0,0 +1,85 @@
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("faiss")
+pytest.importorskip("langchain")
+pytest.importorskip("torch")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from langchain_core.documents import Document  # noqa: E402
+from langchain_core.embeddings import Embeddings  # noqa: E402
+from RetrieverHandler import Retriever  # noqa: E402
+from WriteAheadLog import WriteAheadLog  # noqa: E402
+from index_factory import IndexParams, build_store, save_params  # noqa: E402
+
+DIMENSION = 8
+
+
+class ConstantEmbeddings(Embeddings):
+    def embed_documents(self, texts):
+        return [[1.0] * DIMENSION for _ in texts]
+
+    def embed_query(self, text):
+        return [1.0] * DIMENSION
+
+
+def documents(count: int, start: int = 0):
+    return [Document("document {number}".format(number=number)) for number in range(start, start + count)], \
+        np.random.default_rng(start).random((count, DIMENSION), dtype=np.float32)
+
+
+def open_retriever(root: str) -> Retriever:
+    # новый объект без загруженного индекса — как после перезапуска процесса
+    return Retriever("kb", root, ConstantEmbeddings())
+
+
+def test_records_after_compaction_survive_restart(tmp_path):
+    root: str = str(tmp_path)
+    params = IndexParams()
+    texts, vectors = documents(50)
+    retriever = Retriever("kb", root, ConstantEmbeddings(), params=params)
+    os.makedirs(retriever.path)
+    save_params(retriever.path, params)
+    retriever.save(build_store(ConstantEmbeddings(), texts, vectors, params))
+
+    retriever = open_retriever(root)
+    retriever.append(retriever.writable_store, *documents(3, 50))
+    assert retriever.compact()
+
+    retriever = open_retriever(root)
+    retriever.append(retriever.writable_store, *documents(1, 53))
+
+    retriever = open_retriever(root)
+    assert retriever.store.index.ntotal == 54
+
+
+def test_sequence_continues_from_base_after_truncate(tmp_path):
+    path: str = str(tmp_path / "wal.log")
+    texts, vectors = documents(1)
+    wal = WriteAheadLog(path)
+    wal.append(["a"], [texts[0].page_content], [{}], vectors)
+    wal.append(["b"], [texts[0].page_content], [{}], vectors)
+    wal.truncate(2)
+
+    wal = WriteAheadLog(path, base_seq=2)
+    assert wal.append(["c"], [texts[0].page_content], [{}], vectors) == 3
+    assert [record.seq for record in WriteAheadLog(path, base_seq=2).replay(2)] == [3]
+
+
+def test_flat_snapshot_is_mapped_with_its_documents(tmp_path):
+    root: str = str(tmp_path)
+    params = IndexParams()
+    texts, vectors = documents(10)
+    retriever = Retriever("kb", root, ConstantEmbeddings(), params=params)
+    os.makedirs(retriever.path)
+    save_params(retriever.path, params)
+    retriever.save(build_store(ConstantEmbeddings(), texts, vectors, params))
+
+    retriever = open_retriever(root)
+    store = retriever.store
+    assert retriever.mapped
+    found = retriever.search(store, vectors[3].tolist(), 1)
+    assert found[0][0].page_content == "document 3"
@@ -0,0 +1,427 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from multiprocessing.connection import Connection
+from queue import Queue, Empty
+from threading import Event, Lock, Thread, Timer
+from typing import Dict, List, Optional
+import multiprocessing
+import os
+import logging
+
+# методы, которые меняют состояние каждого процесса и рассылаются всем обработчикам
+BROADCAST_METHODS = {
+    "activate_retriever", "deactivate_retriever", "set_retriever_params", "set_model_params",
+    "set_conversation_mode", "set_answer_cache_params", "set_prompt_params", "set_cancellation_params",
+    "set_speculative_mode",
+}
+# изменения баз знаний на диске выполняет единственный владелец — обработчик 0
+OWNER_METHODS = {
+    "change_retriever_name", "remove_retriever", "add_text_in_retriever", "add_document_in_retriever",
+    "create_retriever_from_document", "rebuild_retriever", "ingestion_status",
+}
+OWNER_PROPERTIES = {"ingestion_jobs", "retrievers_status", "retrievers_cache_stats"}
+PROPERTIES = {"model_params", "retriever_params", "conversation_status", "prompt_params", "prompt_stats",
+              "cancellation_params", "answer_cache_stats", "speculative_stats", "embedding_stats"}
+
+
+class RemoteError(Exception):
+    pass
+
+
+class Channel:
+    def __init__(self, connection: Connection, handler, workers: int = 64) -> None:
+        self.__connection: Connection = connection
+        self.__handler = handler
+        self.__send_lock = Lock()
+        self.__ids = count()
+        self.__pending: Dict[int, Queue] = {}
+        self.__cancel_events: Dict[int, Event] = {}
+        # ожидающие вызовы и счётчик потоков меняют и поток чтения, и потоки запросов
+        self.__state_lock = Lock()
+        self.__pool: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="channel")
+        self.streams: int = 0
+        self.closed: Event = Event()
+        self.__reader = Thread(target=self.__read, daemon=True)
+        self.__reader.start()
+
+    def send(self, message: tuple) -> None:
+        with self.__send_lock:
+            self.__connection.send(message)
+
+    def __register(self) -> tuple:
+        queue: Queue = Queue()
+        with self.__state_lock:
+            call_id: int = next(self.__ids)
+            self.__pending[call_id] = queue
+        return call_id, queue
+
+    def __unregister(self, call_id: int) -> None:
+        with self.__state_lock:
+            self.__pending.pop(call_id, None)
+
+    def call(self, method: str, *args, **kwargs):
+        call_id, queue = self.__register()
+        try:
+            self.send(("call", call_id, method, args, kwargs))
+            kind, value = queue.get()
+        finally:
+            self.__unregister(call_id)
+        if kind == "error":
+            raise RemoteError(value)
+        return value
+
+    def notify(self, method: str, *args) -> None:
+        self.send(("notify", method, args))
+
+    def stream(self, method: str, *args, cancel_event: Optional[Event] = None, **kwargs):
+        call_id, queue = self.__register()
+        with self.__state_lock:
+            self.streams += 1
+        finished: bool = False
+        cancelled: bool = False
+        try:
+            self.send(("stream", call_id, method, args, kwargs))
+            while True:
+                try:
+                    kind, value = queue.get(timeout=0.1)
+                except Empty:
+                    # отмена пересылается обработчику, поток дочитывается до конца
+                    if cancel_event is not None and cancel_event.is_set() and not cancelled:
+                        self.send(("cancel", call_id))
+                        cancelled = True
+                    continue
+                if kind == "item":
+                    yield value
+                    continue
+                finished = True
+                if kind == "error":
+                    raise RemoteError(value)
+                return
+        finally:
+            if not finished:
+                self.send(("cancel", call_id))
+            self.__unregister(call_id)
+            with self.__state_lock:
+                self.streams -= 1
+
+    def __read(self) -> None:
+        while True:
+            try:
+                message: tuple = self.__connection.recv()
+            except (EOFError, OSError):
+                logging.error("Канал обработчика закрыт")
+                self.closed.set()
+                with self.__state_lock:
+                    pending: List[Queue] = list(self.__pending.values())
+                for queue in pending:
+                    queue.put(("error", "connection closed"))
+                return
+            kind: str = message[0]
+            if kind in ("result", "item", "end", "error"):
+                with self.__state_lock:
+                    queue: Optional[Queue] = self.__pending.get(message[1])
+                if queue is not None:
+                    queue.put((kind, message[2] if len(message) > 2 else None))
+            elif kind == "call":
+                self.__pool.submit(self.__serve_call, *message[1:])
+            elif kind == "stream":
+                with self.__state_lock:
+                    self.__cancel_events[message[1]] = Event()
+                self.__pool.submit(self.__serve_stream, *message[1:])
+            elif kind == "cancel":
+                with self.__state_lock:
+                    event: Optional[Event] = self.__cancel_events.get(message[1])
+                if event is not None:
+                    event.set()
+            elif kind == "notify":
+                self.__pool.submit(self.__serve_notify, *message[1:])
+
+    def __serve_call(self, call_id: int, method: str, args: tuple, kwargs: dict) -> None:
+        try:
+            self.send(("result", call_id, getattr(self.__handler, method)(*args, **kwargs)))
+        except Exception as error:
+            self.send(("error", call_id, repr(error)))
+
+    def __serve_stream(self, call_id: int, method: str, args: tuple, kwargs: dict) -> None:
+        with self.__state_lock:
+            cancel_event: Event = self.__cancel_events[call_id]
+        try:
+            for item in getattr(self.__handler, method)(*args, cancel_event=cancel_event, **kwargs):
+                self.send(("item", call_id, item))
+            self.send(("end", call_id))
+        except Exception as error:
+            self.send(("error", call_id, repr(error)))
+        finally:
+            with self.__state_lock:
+                self.__cancel_events.pop(call_id, None)
+
+    def __serve_notify(self, method: str, args: tuple) -> None:
+        try:
+            getattr(self.__handler, method)(*args)
+        except Exception as error:
+            logging.error("Уведомление %s не обработано: %s", method, error)
+
+
+class RemoteChat:
+    def __init__(self, channel: Channel, id: int) -> None:
+        self.__channel: Channel = channel
+        self.id: int = id
+
+    @property
+    def chat_name(self) -> str:
+        return self.__channel.call("chat_name", self.id)
+
+    @chat_name.setter
+    def chat_name(self, chat_name: str) -> None:
+        self.__channel.call("rename_chat", self.id, chat_name)
+
+    @property
+    def chat_history(self) -> List[Dict]:
+        return self.__channel.call("chat_history", self.id)
+
+    def add_pair(self, pair) -> None:
+        self.__channel.call("add_pair", self.id, pair.user, pair.bot)
+
+
+class RemoteChatHandler:
+    # прокси ChatHandler в процессе обработчика: id и запись чатов остаются за фронтовым процессом
+    def __init__(self) -> None:
+        self.channel: Optional[Channel] = None
+
+    def __call__(self, id: int) -> RemoteChat:
+        return RemoteChat(self.channel, id)
+
+    def create_chat(self, chat_name: str) -> int:
+        return self.channel.call("create_chat", chat_name)
+
+
+class WorkerHandler:
+    def __init__(self) -> None:
+        self.model = None
+
+    def invoke(self, name: str, args: tuple = (), kwargs: Optional[dict] = None):
+        attribute = getattr(self.model, name)
+        return attribute(*args, **(kwargs or {})) if callable(attribute) else attribute
+
+    def generate(self, question: str, id: int = -1, timeout: Optional[float] = None, priority: int = 0,
+                 cancel_event: Optional[Event] = None):
+        return self.model(question, id, cancel_event, timeout=timeout, priority=priority)
+
+    def answer_batch(self, questions: list, batch_size: int = 32, cancel_event: Optional[Event] = None):
+        results = self.model.answer_batch(questions, batch_size)
+        try:
+            for result in results:
+                yield result
+                if cancel_event is not None and cancel_event.is_set():
+                    return
+        finally:
+            results.close()
+
+    def refresh_retriever(self, name: Optional[str]) -> None:
+        self.model.refresh_retriever(name)
+
+
+def run_worker(connection: Connection, index: int, owner: bool) -> None:
+    from log_config import configure_logging
+    from model import TextGenerationModel
+    configure_logging("py_log.{index}.log".format(index=index))
+    chats = RemoteChatHandler()
+    handler = WorkerHandler()
+    channel = Channel(connection, handler)
+    chats.channel = channel
+    try:
+        # базы читает каждый обработчик, пишет только владелец
+        handler.model = TextGenerationModel(
+            chats_handler=chats, retrievers_read_only=not owner)
+    except Exception as error:
+        logging.error("Обработчик %s не запустился: %s", index, error)
+        channel.notify("worker_failed", index, repr(error))
+        return
+    if owner:
+        handler.model.add_retriever_listener(
+            lambda name: channel.notify("retriever_changed", name))
+    channel.notify("worker_ready", index, handler.model.startup_timings)
+    # обработчик живёт, пока открыт канал к фронтовому процессу
+    channel.closed.wait()
+
+
+class FrontHandler:
+    def __init__(self, pool: "WorkerPool", index: int) -> None:
+        self.__pool: "WorkerPool" = pool
+        self.__index: int = index
+
+    def create_chat(self, chat_name: str) -> int:
+        id: int = self.__pool.chat_handler.create_chat(chat_name)
+        self.__pool.bind_session(id, self.__index)
+        return id
+
+    def chat_name(self, id: int) -> str:
+        return self.__pool.chat_handler(id).chat_name
+
+    def rename_chat(self, id: int, chat_name: str) -> None:
+        self.__pool.chat_handler(id).chat_name = chat_name
+
+    def chat_history(self, id: int) -> List[Dict]:
+        return self.__pool.chat_handler(id).chat_history
+
+    def add_pair(self, id: int, user: str, bot: str) -> None:
+        from Chat import Pair
+        self.__pool.chat_handler(id).add_pair(Pair(user=user, bot=bot))
+
+    def worker_ready(self, index: int, startup_timings: dict) -> None:
+        self.__pool.mark_ready(index, startup_timings)
+
+    def worker_failed(self, index: int, error: str) -> None:
+        self.__pool.mark_failed(index, error)
+
+    def retriever_changed(self, name: Optional[str]) -> None:
+        self.__pool.broadcast_refresh(name)
+
+
+def private_stores(database_path: str) -> List[str]:
+    # снимки записываются так, что индекс (плоский — как IVF с одним списком) и docstore
+    # отображаются в память и общие для всех обработчиков; целиком в каждый процесс
+    # загружаются только HNSW и снимки старого формата (index.pkl) до ближайшего сжатия или перестройки
+    from index_factory import load_params
+    from MappedDocstore import docstore_exists
+    knowladge_path: str = os.path.join(database_path, "knowladge")
+    if not os.path.isdir(knowladge_path):
+        return []
+    private: List[str] = []
+    for name in sorted(os.listdir(knowladge_path)):
+        path: str = os.path.join(knowladge_path, name)
+        if not os.path.isdir(path):
+            continue
+        snapshot_path: str = path
+        if os.path.exists(os.path.join(path, "CURRENT")):
+            with open(os.path.join(path, "CURRENT"), "r", encoding="utf-8") as file:
+                snapshot_path = os.path.join(path, file.read().strip())
+        if load_params(path).index_type == "hnsw" or not docstore_exists(snapshot_path):
+            private.append(name)
+    return private
+
+
+class WorkerPool:
+    # индексы и docstore баз знаний обработчики читают из общих отображённых файлов
+    def __init__(self, workers: int, chats_path: str = "./chats", chats_backend: str = "jsonl",
+                 max_sessions: int = 10000, database_path: str = "./database", refresh_delay: float = 1.0) -> None:
+        from ChatHandler import ChatHandler
+        private: List[str] = private_stores(database_path)
+        if private and workers > 1:
+            logging.warning(
+                "Базы знаний %s будут загружены в каждый из %s обработчиков (HNSW или снимок старого формата); "
+                "перестройте их через /rebuild_retriever/, чтобы память была общей", private, workers)
+        self.chat_handler = ChatHandler(chats_path, chats_backend)
+        self.startup_timings: Dict[str, dict] = {}
+        self.__error: Optional[str] = None
+        self.__ready: List[Event] = [Event() for _ in range(workers)]
+        self.__sessions: OrderedDict = OrderedDict()
+        self.__max_sessions: int = max_sessions
+        self.__sessions_lock = Lock()
+        self.__refresh_delay: float = refresh_delay
+        self.__refresh_pending: set = set()
+        self.__refresh_timer: Optional[Timer] = None
+        self.__refresh_lock = Lock()
+        self.__channels: List[Channel] = []
+        self.__processes: list = []
+        context = multiprocessing.get_context("spawn")
+        for index in range(workers):
+            front, back = context.Pipe()
+            process = context.Process(target=run_worker, args=(back, index, index == 0),
+                                      name="model-worker-{index}".format(index=index), daemon=True)
+            process.start()
+            back.close()
+            self.__processes.append(process)
+            self.__channels.append(Channel(front, FrontHandler(self, index)))
+        for ready in self.__ready:
+            ready.wait()
+        if self.__error is not None:
+            for process in self.__processes:
+                process.terminate()
+            raise RuntimeError(self.__error)
+        logging.info("Запущено обработчиков модели %s", workers)
+
+    def mark_ready(self, index: int, startup_timings: dict) -> None:
+        self.startup_timings["worker{index}".format(index=index)] = startup_timings
+        self.__ready[index].set()
+
+    def mark_failed(self, index: int, error: str) -> None:
+        self.__error = error
+        for ready in self.__ready:
+            ready.set()
+
+    def bind_session(self, id: int, index: int) -> None:
+        # ход диалога идёт в тот процесс, где лежит KV его сессии
+        with self.__sessions_lock:
+            self.__sessions[id] = index
+            self.__sessions.move_to_end(id)
+            while len(self.__sessions) > self.__max_sessions:
+                self.__sessions.popitem(last=False)
+
+    def __route(self, id: int) -> Channel:
+        with self.__sessions_lock:
+            index: Optional[int] = self.__sessions.get(id)
+        if index is not None:
+            return self.__channels[index]
+        channel: Channel = min(self.__channels, key=lambda channel: channel.streams)
+        # чат, созданный до запуска пула, закрепляется за обработчиком при первом обращении
+        if id != -1:
+            self.bind_session(id, self.__channels.index(channel))
+        return channel
+
+    def remove_chat(self, id: int) -> bool:
+        removed: bool = self.chat_handler.remove_chat(id)
+        if removed:
+            with self.__sessions_lock:
+                index: Optional[int] = self.__sessions.pop(id, None)
+            if index is not None:
+                self.__channels[index].notify("invoke", "drop_session", (id,))
+        return removed
+
+    def broadcast_refresh(self, name: Optional[str]) -> None:
+        # загрузка документа меняет базу пачками; обновления за короткое окно рассылаются одним разом
+        with self.__refresh_lock:
+            self.__refresh_pending.add(name)
+            if self.__refresh_timer is not None:
+                return
+            self.__refresh_timer = Timer(self.__refresh_delay, self.__flush_refresh)
+            self.__refresh_timer.daemon = True
+            self.__refresh_timer.start()
+
+    def __flush_refresh(self) -> None:
+        with self.__refresh_lock:
+            names: set = self.__refresh_pending
+            self.__refresh_pending = set()
+            self.__refresh_timer = None
+        for name in names:
+            for channel in self.__channels[1:]:
+                channel.notify("refresh_retriever", name)
+
+    def __call__(self, question: str, id: int = -1, cancel_event: Optional[Event] = None,
+                 timeout: Optional[float] = None, priority: int = 0):
+        return self.__route(id).stream("generate", question, id, timeout=timeout, priority=priority,
+                                       cancel_event=cancel_event)
+
+    def answer_batch(self, questions: list, batch_size: int = 32):
+        return self.__route(-1).stream("answer_batch", questions, batch_size)
+
+    @property
+    def scheduler_stats(self) -> dict:
+        stats: List[dict] = [channel.call(
+            "invoke", "scheduler_stats") for channel in self.__channels]
+        return {name: sum([item[name] for item in stats]) for name in ("active", "pending")}
+
+    def __getattr__(self, name: str):
+        if name in PROPERTIES or name in OWNER_PROPERTIES:
+            return self.__channels[0].call("invoke", name)
+        if name in BROADCAST_METHODS:
+            def broadcast(*args, **kwargs):
+                results: list = [channel.call("invoke", name, args, kwargs)
+                                 for channel in self.__channels]
+                return results[0]
+            return broadcast
+        if name in OWNER_METHODS:
+            return lambda *args, **kwargs: self.__channels[0].call("invoke", name, args, kwargs)
+        raise AttributeError(name)